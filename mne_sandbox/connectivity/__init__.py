@@ -1,6 +1,8 @@
-from .cfc import (phase_amplitude_coupling,
+from .cfc import (phase_amplitude_coupling, comodulogram,
                   phase_locked_amplitude,
                   phase_binned_amplitude)
 from .viz import (plot_phase_locked_amplitude,
                   plot_phase_binned_amplitude)
 from .simulation import simulate_pac_signal
+from ._accumulator import PACAccumulator
+from ._filter_cache import PACFilterCache
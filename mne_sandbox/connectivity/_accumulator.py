@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Incremental phase-amplitude coupling"""
+
+import numpy as np
+
+# PAC functions that reduce to running sums
+_accumulator_funcs = ['ozkurt', 'plv', 'glm', 'mi_tort']
+
+
+class PACAccumulator(object):
+    """Accumulate phase-amplitude coupling over chunks of data
+
+    PAC metrics like 'ozkurt' reduce to running sums over time (e.g., the sum
+    of ``amp * exp(1j * phase)`` and of ``amp ** 2``). This class keeps only
+    those sums, so that PAC can be computed on data streams or on long
+    recordings one chunk at a time, and accumulators of different workers
+    can be merged without keeping the time series around.
+
+    Parameters
+    ----------
+    pac_func : {'ozkurt', 'plv', 'glm', 'mi_tort'}
+        The PAC metric to accumulate. Defaults to 'ozkurt'.
+    n_bins : int
+        The number of phase bins, only used for 'mi_tort'. Defaults to 20.
+        'mi_canolty' is not supported, see Notes.
+
+    Attributes
+    ----------
+    n_times : int
+        The number of samples ingested so far.
+
+    Notes
+    -----
+    The phase and amplitude given to `update` are the phase of the low
+    frequency signal and the amplitude of the high frequency signal, as in
+    the `filterfn=False` mode of PacPy. For 'plv', the amplitude is the phase
+    of the amplitude envelope filtered in the low frequency band.
+
+    'mi_canolty' can't be accumulated. Its raw modulation index only needs
+    the running sum of ``amp * exp(1j * phase)``, but PacPy z-scores it
+    against surrogates that circularly shift the phase over the whole time
+    series. Each shifted sum pairs samples from different chunks, so it
+    depends on all the data at once, and the z-score of the concatenated
+    data is not a function of any per-chunk sums. Returning the raw index
+    instead would silently give a different metric than 'mi_canolty'
+    everywhere else.
+    """
+    def __init__(self, pac_func='ozkurt', n_bins=20):
+        if pac_func == 'mi_canolty':
+            raise ValueError('mi_canolty is normalized by surrogates of the '
+                             'whole time series and cannot be accumulated '
+                             'over chunks')
+        if pac_func not in _accumulator_funcs:
+            raise ValueError('pac_func must be one of %s, got %s'
+                             % (_accumulator_funcs, pac_func))
+        if n_bins < 2 or n_bins != int(n_bins):
+            raise ValueError('n_bins must be an integer > 1, got %s'
+                             % n_bins)
+        self.pac_func = pac_func
+        self.n_bins = int(n_bins)
+        self._stats = None
+        self.n_times = 0
+
+    def update(self, phase, amp):
+        """Add a chunk of data
+
+        Parameters
+        ----------
+        phase : array, shape (..., n_times)
+            The phase time series.
+        amp : array, shape (..., n_times)
+            The amplitude time series. It must broadcast against `phase`.
+
+        Returns
+        -------
+        self : instance of PACAccumulator
+            The accumulator.
+        """
+        from ..externals.pacpy.pac import _pac_stats
+        phase, amp = np.asarray(phase), np.asarray(amp)
+        if phase.shape[-1] == 0:
+            return self
+        stats = _pac_stats(phase, amp, self.pac_func, Nbins=self.n_bins)
+        self._add(stats)
+        self.n_times += phase.shape[-1]
+        return self
+
+    def merge(self, other):
+        """Add the data of another accumulator to this one
+
+        Parameters
+        ----------
+        other : instance of PACAccumulator
+            The accumulator to merge. It must use the same PAC function and
+            number of bins, and have the same shape.
+
+        Returns
+        -------
+        self : instance of PACAccumulator
+            The accumulator.
+        """
+        if not isinstance(other, PACAccumulator):
+            raise TypeError('other must be an instance of PACAccumulator')
+        if (other.pac_func, other.n_bins) != (self.pac_func, self.n_bins):
+            raise ValueError('Can only merge accumulators with the same '
+                             'pac_func and n_bins')
+        if other._stats is not None:
+            self._add(other._stats)
+            self.n_times += other.n_times
+        return self
+
+    def compute(self):
+        """Compute PAC from the data seen so far
+
+        Returns
+        -------
+        pac : array, shape (...)
+            The PAC value of each time series.
+        """
+        from ..externals.pacpy.pac import _pac_from_stats
+        if self._stats is None:
+            raise RuntimeError('No data have been added to the accumulator')
+        return _pac_from_stats(self._stats, self.pac_func, Nbins=self.n_bins)
+
+    def _add(self, stats):
+        if self._stats is None:
+            self._stats = [i_stat.copy() for i_stat in stats]
+            return
+        if self._stats[-1].shape != stats[-1].shape:
+            raise ValueError('Data shape %s does not match the accumulated '
+                             'shape %s' % (stats[-1].shape,
+                                           self._stats[-1].shape))
+        for i_stat, i_new in zip(self._stats, stats):
+            i_stat += i_new
+
+    def __repr__(self):
+        shape = None if self._stats is None else self._stats[-1].shape
+        return ('<PACAccumulator | %s, shape %s, %d samples>'
+                % (self.pac_func, shape, self.n_times))
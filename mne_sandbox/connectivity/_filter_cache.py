@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache of filtered signals for phase-amplitude coupling"""
+
+import os
+import os.path as op
+import hashlib
+import tempfile
+
+import numpy as np
+from mne.utils import logger
+
+
+class PACFilterCache(object):
+    """Persistent cache of band-pass filtered phase / amplitude signals
+
+    Filtering dominates the cost of phase-amplitude coupling. When the same
+    recording is analyzed many times (e.g., with different PAC functions,
+    windows or events), this cache stores the filtered phase and amplitude
+    of each channel in a directory, so they are computed only once.
+
+    Entries are addressed by a hash of everything they depend on: the data
+    of the channel, the sampling frequency, the frequency bands, the number
+    of cycles and the filter taps. They can thus be shared across runs and
+    Python sessions without ever being stale. When the cache grows beyond
+    `max_size`, the least recently used entries are deleted, down to 90% of
+    `max_size`. The size of the cache is tracked in memory, so the
+    directory is only listed when entries have to be deleted (entries
+    written by other processes are counted from then on).
+
+    Parameters
+    ----------
+    path : str
+        The directory of the cache. It is created if it doesn't exist.
+    max_size : float
+        The maximum size of the cache, in bytes. Defaults to 2e9 (2 GB).
+
+    Attributes
+    ----------
+    hits : int
+        The number of entries read from the cache.
+    misses : int
+        The number of entries that had to be computed.
+    """
+    def __init__(self, path, max_size=2e9):
+        if max_size <= 0:
+            raise ValueError('max_size must be positive, got %s' % max_size)
+        if not op.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None  # Total size of the entries, read on first put
+
+    def key(self, *items):
+        """Hash arrays and parameters into a key
+
+        Parameters
+        ----------
+        *items : arrays, numbers or strings
+            The objects that the cached value depends on.
+
+        Returns
+        -------
+        key : str
+            The hexadecimal digest of the items.
+        """
+        sha = hashlib.sha1()
+        for item in items:
+            item = np.asarray(item)
+            sha.update(str((item.dtype.str, item.shape)).encode('utf-8'))
+            sha.update(np.ascontiguousarray(item).tobytes())
+        return sha.hexdigest()
+
+    def get(self, key):
+        """Read an entry
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry, see `key`.
+
+        Returns
+        -------
+        value : array | None
+            The cached array, or None if it is not in the cache.
+        """
+        fname = self._fname(key)
+        try:
+            value = np.load(fname)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(fname, None)  # Mark as recently used
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Write an entry, then evict old entries if the cache is too large
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry, see `key`.
+        value : array
+            The array to cache.
+        """
+        # Write to a temporary file first, so that concurrent readers never
+        # see a partial entry
+        fid, fname_tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        with os.fdopen(fid, 'wb') as fid:
+            np.save(fid, np.asarray(value))
+        fname = self._fname(key)
+        if self._size is None:
+            self._size = sum(i_size for _, i_size, _ in self._stat_entries())
+        elif op.exists(fname):
+            self._size -= op.getsize(fname)
+        os.rename(fname_tmp, fname)
+        self._size += op.getsize(fname)
+        if self._size > self.max_size:
+            self._evict()
+
+    def clear(self):
+        """Delete all the entries"""
+        for fname in self._entries():
+            os.remove(fname)
+        self._size = 0
+
+    def info(self):
+        """Return a dict with the cache statistics"""
+        return dict(hits=self.hits, misses=self.misses,
+                    size=sum(op.getsize(f) for f in self._entries()),
+                    n_entries=len(self._entries()), max_size=self.max_size)
+
+    def _fname(self, key):
+        return op.join(self.path, key + '.npy')
+
+    def _entries(self):
+        return [op.join(self.path, fname) for fname in os.listdir(self.path)
+                if fname.endswith('.npy')]
+
+    def _stat_entries(self):
+        entries = []
+        for fname in self._entries():
+            try:
+                stat = os.stat(fname)
+            except OSError:  # Deleted by someone else
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        return entries
+
+    def _evict(self):
+        # Delete down to a lower size, so that the directory isn't listed
+        # again on each of the following puts
+        entries = sorted(self._stat_entries())
+        size = sum(i_entry[1] for i_entry in entries)
+        for _, i_size, fname in entries:
+            if size <= 0.9 * self.max_size:
+                break
+            logger.info('Evicting %s from the PAC filter cache' % fname)
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            size -= i_size
+        self._size = size
+
+    def __repr__(self):
+        return '<PACFilterCache | %s, max_size %s>' % (self.path,
+                                                       self.max_size)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Timing of the stages of phase-amplitude coupling computations"""
+
+import time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class _PACTimer(object):
+    """Accumulate the wall-clock time spent in each stage of a PAC run
+
+    Used as ``with timer('filter'): ...``. Stages must not be nested. The
+    timers of parallel jobs are added up with `merge`.
+    """
+    def __init__(self):
+        self.times = dict()
+        self._stage = None
+        self._start = None
+
+    def __call__(self, stage):
+        self._stage = stage
+        return self
+
+    def __enter__(self):
+        self._start = _clock()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = _clock() - self._start
+        self.times[self._stage] = self.times.get(self._stage, 0.) + elapsed
+
+    def merge(self, other):
+        """Add the times of another timer to this one"""
+        for stage, i_time in other.times.items():
+            self.times[stage] = self.times.get(stage, 0.) + i_time
+        return self
+
+
+class _NoTimer(object):
+    """A timer that does nothing, used when no statistics are requested"""
+    def __call__(self, stage):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def merge(self, other):
+        return self
@@ -1,17 +1,25 @@
+import os
+import os.path as op
+import tempfile
+
 import numpy as np
 from mne import BaseEpochs
 from mne.io import BaseRaw
 from mne.time_frequency.tfr import _compute_tfr
 from mne.preprocessing import peak_finder
+from mne.parallel import parallel_func
 from mne.utils import ProgressBar, logger
-from scipy.signal import hilbert
+
+from ..externals.pacpy.util import rfft, ifft, next_fast_len
+from ._accumulator import PACAccumulator
+from ._filter_cache import PACFilterCache
+from ._instrument import _PACTimer, _NoTimer, _clock
 from itertools import product
-import mne
-import warnings
+from numpy.lib.stride_tricks import as_strided
 
 
 # Supported PAC functions
-_pac_funcs = ['plv', 'glm', 'mi_tort', 'mi_canolty', 'ozkurt', 'otc']
+_pac_funcs = ['plv', 'glm', 'mi_tort', 'mi_canolty', 'ozkurt']
 # Calculate the phase of the amplitude signal for these PAC funcs
 _hi_phase_funcs = ['plv']
 
@@ -20,13 +28,21 @@ def phase_amplitude_coupling(inst, f_phase, f_amp, ixs, pac_func='ozkurt',
                              events=None, tmin=None, tmax=None,
                              n_cycles_ph=3, n_cycles_am=3,
                              scale_amp_func=None, return_data=False,
-                             concat_epochs=False, n_jobs=1, verbose=None):
+                             concat_epochs=False, block_duration=None,
+                             sliding_window=None, n_surrogates=None,
+                             surrogate_method='time_shift',
+                             random_state=None, cache_dir=None,
+                             filter_cache=None, dtype=np.float64,
+                             multirate=False, decim=1, callback=None,
+                             n_jobs=1, verbose=None):
     """ Compute phase-amplitude coupling between pairs of signals using pacpy.
 
     Parameters
     ----------
     inst : an instance of Raw or Epochs
-        The data used to calculate PAC.
+        The data used to calculate PAC. Each epoch of Epochs is filtered
+        separately, and PAC is calculated per epoch (or per event type, see
+        `concat_epochs`).
     f_phase : array, dtype float, shape (n_bands_phase, 2,)
         The frequency ranges to use for the phase carrier. PAC will be
         calculated between n_bands_phase * n_bands_amp frequencies.
@@ -42,20 +58,24 @@ def phase_amplitude_coupling(inst, f_phase, f_amp, ixs, pac_func='ozkurt',
         `pacpy.pac`. Defaults to 'ozkurt'. If multiple frequency bands are used
         then `plv` cannot be calculated.
     events : array, shape (n_events, 3) | array, shape (n_events,) | None
-        MNE events array. To be supplied if data is 2D and output should be
+        MNE events array. To be supplied if data is Raw and output should be
         split by events. In this case, `tmin` and `tmax` must be provided. If
         `ndim == 1`, it is assumed to be event indices, and all events will be
-        grouped together.
+        grouped together. Must be None for Epochs, whose own events are used.
+        The PAC of events whose windows extend beyond the data is NaN (or
+        these events are left out of their group with `concat_epochs`).
     tmin : float | list of floats, shape (n_pac_windows,) | None
         If `events` is not provided, it is the start time to use in `inst`.
         If `events` is provided, it is the time (in seconds) to include before
-        each event index. If a list of floats is given, then PAC is calculated
-        for each pair of `tmin` and `tmax`. Defaults to `min(inst.times)`.
+        each event index. For Epochs, it is relative to the epoch times. If a
+        list of floats is given, then PAC is calculated for each pair of
+        `tmin` and `tmax`. Defaults to `min(inst.times)`.
     tmax : float | list of floats, shape (n_pac_windows,) | None
         If `events` is not provided, it is the stop time to use in `inst`.
         If `events` is provided, it is the time (in seconds) to include after
-        each event index. If a list of floats is given, then PAC is calculated
-        for each pair of `tmin` and `tmax`. Defaults to `max(inst.n_times)`.
+        each event index. For Epochs, it is relative to the epoch times. If a
+        list of floats is given, then PAC is calculated for each pair of
+        `tmin` and `tmax`. Defaults to `max(inst.times)`.
     n_cycles_ph : float, int | array of floats, shape (n_bands_phase,)
         The number of cycles to be included in the window for each band-pass
         filter for phase. Defaults to 3.
@@ -74,8 +94,111 @@ def phase_amplitude_coupling(inst, f_phase, f_amp, ixs, pac_func='ozkurt',
         If True, epochs will be concatenated before calculating PAC values. If
         epochs are relatively short, this is a good idea in order to improve
         stability of the PAC metric.
+    block_duration : float | None
+        If not None, the data are read, filtered and reduced in blocks of
+        `block_duration` seconds, so that only the channels in `ixs` and a
+        single block are in memory at a time. Blocks overlap by the length of
+        the longest filter and the overlaps are discarded after filtering.
+        Only supported without `events`, `scale_amp_func` and `return_data`,
+        and for the 'ozkurt', 'plv', 'glm' and 'mi_tort' PAC functions.
+        Defaults to None, which loads all the data at once.
+    sliding_window : tuple of float, shape (2,) | None
+        If not None, the duration and the step (in seconds) of windows that
+        slide between `tmin` and `tmax`, which must be single values, and
+        PAC is calculated in each window. Window ``ii`` starts at
+        ``tmin + ii * step``. The sufficient statistics of the PAC function
+        are summed cumulatively over time, so the cost doesn't grow with the
+        overlap of the windows. Only supported for the 'ozkurt', 'plv',
+        'glm' and 'mi_tort' PAC functions, and not with `concat_epochs`,
+        `block_duration` or `n_surrogates`. Defaults to None.
+    n_surrogates : int | None
+        If not None, PAC is also calculated on `n_surrogates` surrogate
+        datasets, and the z-score and p-value of each PAC value compared to
+        this null distribution are returned. Surrogates reuse the filtered
+        phase and amplitude, so they cost much less than filtering.
+        Not supported with `block_duration` or 'mi_canolty', which is
+        already normalized by surrogates. Defaults to None.
+    surrogate_method : 'time_shift' | 'epoch_shuffle'
+        How to build the surrogates. 'time_shift' circularly shifts the
+        phase of each epoch and window (or of the concatenated epochs) by a
+        random number of samples.
+        'epoch_shuffle' pairs the phase of each epoch with the amplitude of
+        another epoch of the same event type, never with its own, and
+        requires `events` with at least three epochs per event type.
+        Defaults to 'time_shift'.
+    random_state : None | int | instance of RandomState | Generator
+        The random number generator used for the surrogates, or its seed.
+        Defaults to None.
+    cache_dir : str | None
+        If not None, an existing directory where the filtered phase and
+        amplitude signals are stored as float32 memory-mapped files, which
+        are read one frequency band at a time to compute PAC. This allows
+        computing PAC when these signals don't fit in memory. The files are
+        deleted at the end, unless `return_data` is True, in which case the
+        returned signals are the memory-mapped arrays. Not supported with
+        `block_duration`. Defaults to None, which keeps them in memory.
+    filter_cache : str | instance of PACFilterCache | None
+        If not None, a persistent cache (or the directory of one) where the
+        filtered phase and amplitude of each channel are stored, and reused
+        by later calls on the same data with the same filters. Not supported
+        with `block_duration`. Defaults to None.
+    dtype : 'float64' | 'float32'
+        The precision of filtering and PAC computations. float32 halves the
+        memory needed for the filtered signals, at the cost of an error of
+        about 1e-6 in PAC values. Defaults to float64.
+    multirate : bool
+        If True, the phase of each band is computed at a lower sampling rate,
+        which keeps the frequencies passed by its filter and samples the top
+        of the band 32 times per cycle, and it is linearly interpolated back
+        to the full rate. This saves most of the cost of the inverse FFTs of
+        low frequency phase bands on data with a high sampling rate, at the
+        cost of phase errors of about 0.01 radians (larger where the
+        amplitude of the band is close to zero). Defaults to False.
+    decim : int | 'auto'
+        If greater than 1, the filtered phase and amplitude signals are
+        decimated by `decim` before PAC is calculated, so the PAC functions run
+        on `decim` times fewer samples. The band-pass filters act as the
+        anti-aliasing filters, and no other low-pass filter is applied (the
+        wrapped phase and the envelope are not band-limited, so filtering them
+        would change their values): phase and amplitude signals are exact at
+        the samples that are kept, and only the sums over time of the PAC
+        functions are approximated. If the decimated rate is above twice the
+        highest frequency of their summands (e.g., ``amp * cos(phase)``), these
+        sums are exact up to edge terms, and the relative error of PAC is of
+        the order of ``decim / n_window``, where ``n_window`` is the number of
+        samples of a PAC window (or epoch). 'mi_tort', which bins the phase, is
+        less exact. 'auto' picks the largest `decim` that keeps the decimated
+        rate above twice the sum of the top frequency of the phase bands and
+        the width of the amplitude bands, which bounds the frequencies of these
+        summands. Windows, sliding windows and events are rounded to the
+        decimated samples, and the signals returned with `return_data` are
+        decimated. Not supported with `block_duration`. Defaults to 1, which
+        uses every sample.
+    callback : callable | None
+        If not None, it is called at the end of the computation with a dict
+        of statistics, to monitor and size PAC runs:
+
+        - ``'times'``: dict with the wall-clock time (in seconds) spent in
+          each stage: ``'filter'`` (band-pass filtering and Hilbert
+          transform, which are done together), ``'epoch'`` (gathering
+          epochs and windows), ``'metric'`` (PAC functions),
+          ``'surrogates'`` (if `n_surrogates` is not None) and ``'total'``.
+          Parallel jobs add up, so stages can exceed the total time.
+        - ``'n_samples'``: the number of samples of data used (channels
+          times time points).
+        - ``'samples_per_second'``: the throughput, ``n_samples`` divided
+          by the total time.
+        - ``'memory'``: an estimate of the peak memory used by the data,
+          the filtered signals and the epochs of the parallel jobs, in
+          bytes. Temporary arrays of the PAC functions are not included.
+
+        Not supported with `block_duration`. Defaults to None, in which case
+        nothing is measured.
     n_jobs : int
-        Number of jobs to run in parallel. Defaults to 1.
+        Number of jobs to run in parallel. Work is split across frequency
+        pairs, and across channel pairs if there are fewer frequency pairs
+        than jobs. With `block_duration`, work is split across blocks.
+        Defaults to 1.
     verbose : bool, str, int, or None
         If not None, override default verbose level (see `mne.verbose`).
 
@@ -88,22 +211,61 @@ def phase_amplitude_coupling(inst, f_phase, f_amp, ixs, pac_func='ozkurt',
         given in ixs. If multiple pac metrics are specified, there will be one
         array per metric in the output list. If n_pac_funcs is 1, then the
         first dimension will be dropped.
-    [phase_signal] : array, shape (n_phase_signals, n_times,)
+    freq_pac : array, shape (n_freq_pairs, 2, 2)
+        The phase and amplitude frequency bands of each frequency pair.
+    [pac_z] : array, list of arrays, dtype float, same shape as `pac_out`
+        Only returned if `n_surrogates` is not None. The z-score of each PAC
+        value relative to its surrogates.
+    [pac_p] : array, list of arrays, dtype float, same shape as `pac_out`
+        Only returned if `n_surrogates` is not None. The fraction of
+        surrogates with PAC at least as large as each PAC value, counting
+        the PAC value itself, i.e. ``(1 + n_larger) / (1 + n_surrogates)``.
+    [phase_signal] : array, shape (n_phase_signals, n_bands_phase, n_times)
         Only returned if `return_data` is True. The phase timeseries of the
-        phase signals (first column of `ixs`).
-    [amp_signal] : array, shape (n_amp_signals, n_times,)
+        phase signals (first column of `ixs`). For Epochs, the epochs are
+        laid end to end in time.
+    [amp_signal] : array, shape (n_amp_signals, n_bands_amp, n_times)
         Only returned if `return_data` is True. The amplitude timeseries of the
-        amplitude signals (second column of `ixs`).
+        amplitude signals (second column of `ixs`). For Epochs, the epochs
+        are laid end to end in time.
 
     References
     ----------
     [1] This function uses the PacPy module developed by the Voytek lab.
         https://github.com/voytekresearch/pacpy
     """
-    if not isinstance(inst, BaseRaw):
-        raise ValueError('Must supply Raw as input')
+    if not isinstance(inst, (BaseRaw, BaseEpochs)):
+        raise ValueError('Must supply Raw or Epochs as input')
     sfreq = inst.info['sfreq']
-    data = inst[:][0]
+    # Only read the channels that we use
+    ixs = np.array(ixs, ndmin=2)
+    picks = np.unique(ixs)
+    ixs = np.searchsorted(picks, ixs)
+    if isinstance(inst, BaseEpochs):
+        if events is not None or block_duration is not None:
+            raise ValueError('events and block_duration are not supported '
+                             'with Epochs')
+        # Windows are relative to the first sample of each epoch
+        tmin = None if tmin is None else np.asarray(tmin) - inst.times[0]
+        tmax = None if tmax is None else np.asarray(tmax) - inst.times[0]
+        data = inst.get_data(picks=picks)
+        events = inst.events
+    elif block_duration is not None:
+        unsupported = [events, scale_amp_func, sliding_window, n_surrogates,
+                       cache_dir, filter_cache, callback]
+        has_unsupported = any(i_arg is not None for i_arg in unsupported)
+        if has_unsupported or return_data or decim != 1:
+            raise ValueError('events, return_data, scale_amp_func, '
+                             'sliding_window, n_surrogates, cache_dir, '
+                             'filter_cache, decim and callback are not '
+                             'supported with block_duration')
+        return _phase_amplitude_coupling_blocks(
+            inst, picks, f_phase, f_amp, ixs, pac_func=pac_func, tmin=tmin,
+            tmax=tmax, n_cycles_ph=n_cycles_ph, n_cycles_am=n_cycles_am,
+            block_duration=block_duration, dtype=dtype, multirate=multirate,
+            n_jobs=n_jobs)
+    else:
+        data = inst[picks, :][0]
     pac = _phase_amplitude_coupling(data, sfreq, f_phase, f_amp, ixs,
                                     pac_func=pac_func, events=events,
                                     tmin=tmin, tmax=tmax,
@@ -112,14 +274,127 @@ def phase_amplitude_coupling(inst, f_phase, f_amp, ixs, pac_func='ozkurt',
                                     scale_amp_func=scale_amp_func,
                                     return_data=return_data,
                                     concat_epochs=concat_epochs,
-                                    n_jobs=n_jobs, verbose=verbose)
-    # Collect the data properly
-    if return_data is True:
-        pac, freq_pac, data_ph, data_am = pac
-        return pac, freq_pac, data_ph, data_am
+                                    sliding_window=sliding_window,
+                                    n_surrogates=n_surrogates,
+                                    surrogate_method=surrogate_method,
+                                    random_state=random_state,
+                                    cache_dir=cache_dir,
+                                    filter_cache=filter_cache, dtype=dtype,
+                                    multirate=multirate, decim=decim,
+                                    callback=callback, n_jobs=n_jobs,
+                                    verbose=verbose)
+    return pac
+
+
+def comodulogram(inst, f_phase, f_amp, ixs=None, picks=None,
+                 pac_func='ozkurt', tmin=None, tmax=None, n_cycles_ph=3,
+                 n_cycles_am=3, filter_cache=None, dtype=np.float64,
+                 multirate=False, decim=1, callback=None, n_jobs=1,
+                 verbose=None):
+    """Compute comodulograms between many pairs of channels.
+
+    Each channel is filtered only once per frequency band, and PAC is then
+    calculated between every phase band and every amplitude band for all
+    channel pairs.
+
+    Parameters
+    ----------
+    inst : an instance of Raw or Epochs
+        The data used to calculate PAC. For Epochs, PAC is calculated in each
+        epoch and averaged across epochs.
+    f_phase : array, dtype float, shape (n_bands_phase, 2,)
+        The frequency ranges to use for the phase carrier.
+    f_amp : array, dtype float, shape (n_bands_amp, 2,)
+        The frequency ranges to use for the phase-modulated amplitude.
+    ixs : array-like, shape (n_ch_pairs x 2) | None
+        The indices for low/high frequency channels. If None, all the
+        (ordered) pairs of channels in `picks` are used, including each
+        channel with itself.
+    picks : array-like of int | None
+        The channels to pair if `ixs` is None. Defaults to all channels.
+    pac_func : {'glm', 'mi_canolty', 'mi_tort', 'ozkurt'} | list of strings
+        The function for estimating PAC. Corresponds to functions in
+        `pacpy.pac`. Defaults to 'ozkurt'.
+    tmin : float | None
+        The start time of the data to use. For Epochs, it is relative to the
+        epoch onset. Defaults to the start of the data.
+    tmax : float | None
+        The stop time of the data to use. For Epochs, it is relative to the
+        epoch onset. Defaults to the end of the data.
+    n_cycles_ph : float, int | array of floats, shape (n_bands_phase,)
+        The number of cycles to be included in the window for each band-pass
+        filter for phase. Defaults to 3.
+    n_cycles_am : float, int | array of floats, shape (n_bands_amp,)
+        The number of cycles to be included in the window for each band-pass
+        filter for amplitude. Defaults to 3.
+    filter_cache : str | instance of PACFilterCache | None
+        If not None, a persistent cache (or the directory of one) where the
+        filtered signals of each channel are stored, and reused by later
+        calls. Defaults to None.
+    dtype : 'float64' | 'float32'
+        The precision of filtering and PAC computations. Defaults to float64.
+    multirate : bool
+        If True, the phase of each band is computed at a lower sampling rate
+        and interpolated back (see `phase_amplitude_coupling`). Defaults to
+        False.
+    decim : int | 'auto'
+        The decimation of the filtered signals before PAC is calculated
+        (see `phase_amplitude_coupling`). Defaults to 1.
+    callback : callable | None
+        If not None, it is called at the end of the computation with a dict
+        of timing, throughput and memory statistics (see
+        `phase_amplitude_coupling`). Defaults to None.
+    n_jobs : int
+        Number of jobs to run in parallel, across frequency and channel
+        pairs. Defaults to 1.
+    verbose : bool, str, int, or None
+        If not None, override default verbose level (see `mne.verbose`).
+
+    Returns
+    -------
+    comod : array, dtype float,
+            shape ([n_pac_funcs], n_ch_pairs, n_bands_phase, n_bands_amp)
+        The comodulogram of each pair of channels. If n_pac_funcs is 1, then
+        the first dimension will be dropped.
+    ixs : array, shape (n_ch_pairs, 2)
+        The indices of the phase and amplitude channels of each pair.
+    """
+    if not isinstance(inst, (BaseRaw, BaseEpochs)):
+        raise ValueError('Must supply Raw or Epochs as input')
+    if ixs is None:
+        picks = np.arange(len(inst.ch_names)) if picks is None else picks
+        ixs = list(product(picks, picks))
+    ixs = np.array(ixs, ndmin=2)
+    if ixs.shape[1] != 2:
+        raise ValueError('Indices must have have a 2nd dimension of length 2')
+    f_phase, f_amp = np.atleast_2d(f_phase), np.atleast_2d(f_amp)
+    n_ph, n_am = f_phase.shape[0], f_amp.shape[0]
+
+    # Only read the channels that we use
+    ch_picks = np.unique(ixs)
+    ixs_data = np.searchsorted(ch_picks, ixs)
+    if isinstance(inst, BaseRaw):
+        data = inst[ch_picks, :][0][np.newaxis]
     else:
-        pac, freq_pac = pac
-        return pac, freq_pac
+        data = inst.get_data(picks=ch_picks)
+    tmin = None if tmin is None else tmin - inst.times[0]
+    tmax = None if tmax is None else tmax - inst.times[0]
+
+    # Stack epochs as channels, so they're all filtered in one pass
+    n_epochs, n_chs = data.shape[:2]
+    ixs_data = np.vstack([ixs_data + ii * n_chs for ii in range(n_epochs)])
+    data = data.reshape(n_epochs * n_chs, -1)
+    pac, _ = _phase_amplitude_coupling(
+        data, inst.info['sfreq'], f_phase, f_amp, ixs_data, pac_func=pac_func,
+        tmin=tmin, tmax=tmax, n_cycles_ph=n_cycles_ph,
+        n_cycles_am=n_cycles_am, filter_cache=filter_cache, dtype=dtype,
+        multirate=multirate, decim=decim, callback=callback, n_jobs=n_jobs,
+        verbose=verbose)
+
+    # (..., 1, n_epochs * n_ch_pairs, n_bands_phase * n_bands_amp, 1) to
+    # (..., n_ch_pairs, n_bands_phase, n_bands_amp)
+    pac = pac.reshape(pac.shape[:-4] + (n_epochs, len(ixs), n_ph, n_am))
+    return pac.mean(-4), ixs
 
 
 def _phase_amplitude_coupling(data, sfreq, f_phase, f_amp, ixs,
@@ -127,6 +402,11 @@ def _phase_amplitude_coupling(data, sfreq, f_phase, f_amp, ixs,
                               tmin=None, tmax=None, n_cycles_ph=3,
                               n_cycles_am=3, scale_amp_func=None,
                               return_data=False, concat_epochs=False,
+                              sliding_window=None, n_surrogates=None,
+                              surrogate_method='time_shift',
+                              random_state=None, cache_dir=None,
+                              filter_cache=None, dtype=np.float64,
+                              multirate=False, decim=1, callback=None,
                               n_jobs=1, verbose=None):
     """ Compute phase-amplitude coupling using pacpy.
 
@@ -154,16 +434,20 @@ def _phase_amplitude_coupling(data, sfreq, f_phase, f_amp, ixs,
         MNE events array. To be supplied if data is 2D and output should be
         split by events. In this case, `tmin` and `tmax` must be provided. If
         `ndim == 1`, it is assumed to be event indices, and all events will be
-        grouped together.
+        grouped together. If data is 3D, these are the events of the epochs,
+        and only their event types are used. The PAC of events whose windows
+        extend beyond the data is NaN.
     tmin : float | list of floats, shape (n_pac_windows,) | None
         If `events` is not provided, it is the start time to use in `inst`.
         If `events` is provided, it is the time (in seconds) to include before
-        each event index. If a list of floats is given, then PAC is calculated
+        each event index. If data is 3D, it is relative to the start of each
+        epoch. If a list of floats is given, then PAC is calculated
         for each pair of `tmin` and `tmax`. Defaults to `min(inst.times)`.
     tmax : float | list of floats, shape (n_pac_windows,) | None
         If `events` is not provided, it is the stop time to use in `inst`.
         If `events` is provided, it is the time (in seconds) to include after
-        each event index. If a list of floats is given, then PAC is calculated
+        each event index. If data is 3D, it is relative to the start of each
+        epoch. If a list of floats is given, then PAC is calculated
         for each pair of `tmin` and `tmax`. Defaults to `max(inst.n_times)`.
     n_cycles_ph : float, int | array of floats, shape (n_bands_phase,)
         The number of cycles to be included in the window for each band-pass
@@ -183,8 +467,40 @@ def _phase_amplitude_coupling(data, sfreq, f_phase, f_amp, ixs,
         If True, epochs will be concatenated before calculating PAC values. If
         epochs are relatively short, this is a good idea in order to improve
         stability of the PAC metric.
+    sliding_window : tuple of float, shape (2,) | None
+        If not None, the duration and step (in seconds) of windows sliding
+        between `tmin` and `tmax`. Defaults to None.
+    n_surrogates : int | None
+        If not None, the number of surrogates used to compute the z-score
+        and p-value of each PAC value. Defaults to None.
+    surrogate_method : 'time_shift' | 'epoch_shuffle'
+        Circularly shift the phase of each epoch, or pair the phase and the
+        amplitude of different epochs of the same event type.
+        Defaults to 'time_shift'.
+    random_state : None | int | instance of RandomState | Generator
+        The random number generator used for the surrogates, or its seed.
+        Defaults to None.
+    cache_dir : str | None
+        If not None, the directory where the filtered phase and amplitude
+        are stored as float32 memmaps. Defaults to None.
+    filter_cache : str | instance of PACFilterCache | None
+        If not None, the persistent cache of filtered signals, or its
+        directory. Defaults to None.
+    dtype : 'float64' | 'float32'
+        The precision of filtering and PAC computations. Defaults to float64.
+    multirate : bool
+        If True, phase is computed at a lower rate and interpolated back
+        (see `_filter_and_hilbert`). Defaults to False.
+    decim : int | 'auto'
+        The decimation of the filtered signals before PAC is calculated
+        (see `phase_amplitude_coupling`). Defaults to 1.
+    callback : callable | None
+        If not None, called at the end with a dict of statistics (see
+        `_pac_run_stats`). Defaults to None.
     n_jobs : int
-        Number of jobs to run in parallel. Defaults to 1.
+        Number of jobs to run in parallel. Work is split across frequency
+        pairs, and across channel pairs if there are fewer frequency pairs
+        than jobs. Defaults to 1.
     verbose : bool, str, int, or None
         If not None, override default verbose level (see `mne.verbose`).
 
@@ -197,6 +513,14 @@ def _phase_amplitude_coupling(data, sfreq, f_phase, f_amp, ixs,
         given in ixs. If multiple pac metrics are specified, there will be one
         array per metric in the output list. If n_pac_funcs is 1, then the
         first dimension will be dropped.
+    freq_pac : array, shape (n_freq_pairs, 2, 2)
+        The phase and amplitude frequency bands of each frequency pair.
+    [pac_z] : array, list of arrays, dtype float, same shape as `pac_out`
+        Only returned if `n_surrogates` is not None. The z-score of each PAC
+        value relative to its surrogates.
+    [pac_p] : array, list of arrays, dtype float, same shape as `pac_out`
+        Only returned if `n_surrogates` is not None. The p-value of each PAC
+        value relative to its surrogates.
     [phase_signal] : array, shape (n_phase_signals, n_times,)
         Only returned if `return_data` is True. The phase timeseries of the
         phase signals (first column of `ixs`).
@@ -204,18 +528,243 @@ def _phase_amplitude_coupling(data, sfreq, f_phase, f_amp, ixs,
         Only returned if `return_data` is True. The amplitude timeseries of the
         amplitude signals (second column of `ixs`).
     """
-    from ..externals.pacpy import pac as ppac
+    if data.ndim not in (2, 3):
+        raise ValueError('Data must be shape ([n_epochs], n_channels, '
+                         'n_times)')
+    if callback is not None and not callable(callback):
+        raise ValueError('callback must be None or callable, got %s'
+                         % (callback,))
+    start = _clock()
+    timer = _NoTimer() if callback is None else _PACTimer()
+    (pac_func, ixs, tmin, tmax, f_phase, f_amp, n_cycles_ph, n_cycles_am,
+     hi_phase) = _check_pac_params(sfreq, data.shape[-1], f_phase, f_amp,
+                                   ixs, pac_func, tmin, tmax, n_cycles_ph,
+                                   n_cycles_am)
+    # The PAC metrics are computed at sfreq / decim
+    decim = _check_decim(decim, sfreq, f_phase, f_amp, n_cycles_ph,
+                         n_cycles_am)
+    sfreq_decim = sfreq / float(decim)
+    n_times_decim = (data.shape[-1] - 1) // decim + 1
+    if decim > 1 and events is not None and data.ndim == 2:
+        events = _decim_events(events, decim)
+    elif decim > 1:
+        # Don't round the end of the data past the last decimated sample
+        tmax = np.minimum(tmax, (n_times_decim - 1) / sfreq_decim)
+    n_pac_funcs = pac_func.shape[0]
+    n_ch_pairs = ixs.shape[0]
+    n_pac_windows = len(tmin)
+    if sliding_window is not None:
+        if concat_epochs is True or n_surrogates is not None:
+            raise ValueError('concat_epochs and n_surrogates are not '
+                             'supported with sliding_window')
+        sliding_window, n_pac_windows = _check_sliding_window(
+            sliding_window, sfreq_decim, tmin, tmax, pac_func)
+
+    logger.info('Pre-filtering data and extracting phase/amplitude...')
+    with timer('filter'):
+        data_ph, data_am, ix_map_ph, ix_map_am = _pre_filter_ph_am(
+            data, sfreq, ixs, f_phase, f_amp, hi_phase=hi_phase,
+            scale_amp_func=scale_amp_func, n_cycles_ph=n_cycles_ph,
+            n_cycles_am=n_cycles_am, cache_dir=cache_dir,
+            filter_cache=_check_filter_cache(filter_cache),
+            dtype=_check_dtype(dtype), multirate=multirate, decim=decim)
+
+    # Sample indices of each epoch / window, so we can slice the filtered
+    # arrays directly
+    if data.ndim == 3:
+        # Filtered epochs are laid end to end in time
+        ev_samps, ev_groups, windows, ev_keep = _epochs_sample_ixs(
+            events, tmin, tmax, sfreq_decim, data.shape[0], n_times_decim)
+    else:
+        ev_samps, ev_groups, windows, ev_keep = _epoch_sample_ixs(
+            events, tmin, tmax, sfreq_decim, n_times_decim)
+
+    # So we know how big the PAC output will be. PAC is computed for the
+    # kept events only, and put back in the rows of all events at the end
+    if ev_samps is None:
+        n_epochs = 1
+    elif concat_epochs is True:
+        n_epochs = len(ev_groups)
+    else:
+        n_epochs = len(ev_samps)
+
+    # Draw the surrogates here so they don't depend on n_jobs
+    surr_ixs = None
+    if n_surrogates is not None:
+        surr_ixs = _draw_surrogates(n_surrogates, surrogate_method, pac_func,
+                                    ev_samps, ev_groups, windows,
+                                    random_state)
+
+    # Gather the epochs with the same sample indices for all frequency pairs
+    samp_ixs = _window_sample_ixs(ev_samps, windows)
+
+    # Iterate through each pair of frequencies
+    ixs_freqs = product(range(data_ph.shape[1]), range(data_am.shape[1]))
+    ixs_freqs = np.atleast_2d(list(ixs_freqs))
+
+    freq_pac = np.array([[f_phase[ii], f_amp[jj]] for ii, jj in ixs_freqs])
+    n_f_pairs = len(ixs_freqs)
+    n_out = 1 if n_surrogates is None else 3
+    pac = np.zeros([n_out, n_pac_funcs, n_epochs, n_ch_pairs,
+                    n_f_pairs, n_pac_windows])
+
+    # Redefine indices to match the new data arrays
+    ixs_new = np.array([(ix_map_ph[i], ix_map_am[j]) for i, j in ixs])
+
+    # Shard the work by frequency pair, and by channel pair if there are
+    # fewer frequency pairs than jobs
+    n_ch_splits = min(int(np.ceil(n_jobs / float(n_f_pairs))), n_ch_pairs)
+    ch_splits = np.array_split(np.arange(n_ch_pairs), max(n_ch_splits, 1))
+    jobs = [(i_f_pair, ix_f_ph, ix_f_am, i_split)
+            for i_f_pair, (ix_f_ph, ix_f_am) in enumerate(ixs_freqs)
+            for i_split in ch_splits]
+    parallel, my_pac_freq_pair, _ = parallel_func(_pac_freq_pair, n_jobs)
+    out = parallel(my_pac_freq_pair(
+        data_ph[:, ix_f_ph], data_am[:, ix_f_am], ixs_new[i_split], pac_func,
+        samp_ixs, ev_groups, windows, concat_epochs, n_epochs,
+        surrogate_method, surr_ixs, sliding_window,
+        None if callback is None else _PACTimer())
+        for _, ix_f_ph, ix_f_am, i_split in jobs)
+
+    # Results come back in the same order as the jobs
+    for (i_f_pair, _, _, i_split), (i_pac, i_timer) in zip(jobs, out):
+        pac[..., i_split, i_f_pair, :] = i_pac
+        timer.merge(i_timer)
+    if callback is not None:
+        # Largest epochs of phase and amplitude gathered by a job at once
+        n_ev = 1 if ev_samps is None else len(ev_samps)
+        n_ch_job = max(len(i_split) for i_split in ch_splits)
+        n_bytes_sample = 2 * n_ev * n_ch_job * data_ph.dtype.itemsize
+        n_bytes_epochs = n_bytes_sample * np.diff(windows).max()
+        n_bytes_filt = sum(0 if isinstance(i_data, np.memmap) else
+                           i_data.nbytes for i_data in (data_ph, data_am))
+        n_bytes_jobs = min(n_jobs, len(jobs)) * n_bytes_epochs
+        memory = data.nbytes + pac.nbytes + n_bytes_jobs + n_bytes_filt
+        callback(_pac_run_stats(timer, _clock() - start, data.size, memory))
+    if ev_keep is not None and concat_epochs is False:
+        # The PAC of dropped events is NaN
+        pac_keep = pac
+        n_events = np.atleast_1d(events).shape[0]
+        pac = np.full(pac.shape[:2] + (n_events,) + pac.shape[3:], np.nan)
+        pac[:, :, ev_keep] = pac_keep
+    if pac.shape[1] == 1:
+        pac = pac[:, 0]
+    out = (pac[0], freq_pac) + tuple(pac[1:])
+    if return_data:
+        out += (data_ph, data_am)
+    else:
+        for i_data in (data_ph, data_am):
+            _clear_cache_array(i_data)
+    return out
+
+
+def _pac_run_stats(timer, total, n_samples, memory):
+    """Gather the statistics of a PAC run that are given to its callback."""
+    times = dict(timer.times, total=total)
+    return dict(times=times, n_samples=int(n_samples),
+                samples_per_second=n_samples / max(total, 1e-12),
+                memory=int(memory))
+
+
+def _check_filter_cache(filter_cache):
+    """Turn a directory into a PACFilterCache."""
+    if filter_cache is None or isinstance(filter_cache, PACFilterCache):
+        return filter_cache
+    if isinstance(filter_cache, str):
+        return PACFilterCache(filter_cache)
+    raise ValueError('filter_cache must be None, a str or an instance of '
+                     'PACFilterCache, got %s' % (filter_cache,))
+
+
+def _draw_surrogates(n_surrogates, surrogate_method, pac_func, ev_samps,
+                     ev_groups, windows, random_state=None):
+    """Draw the random time shifts or epoch permutations of the surrogates.
+
+    For 'time_shift', returns an array of shape (n_pac_windows, n_surrogates)
+    with the shifts of each window, as a fraction of the length of the
+    shifted (possibly concatenated) time series. For 'epoch_shuffle', returns
+    an array of shape (n_surrogates, n_epochs) with the epoch whose phase is
+    paired with each epoch, always another epoch of the same event type.
+    """
+    from ..externals.pacpy.pac import _check_random_state
+    if n_surrogates < 1 or n_surrogates != int(n_surrogates):
+        raise ValueError('n_surrogates must be a positive integer, got %s'
+                         % n_surrogates)
+    if 'mi_canolty' in pac_func:
+        raise ValueError('mi_canolty is already normalized by surrogates, '
+                         'n_surrogates is not supported')
+    rng = _check_random_state(random_state)
+    n_surrogates = int(n_surrogates)
+    if surrogate_method == 'time_shift':
+        return rng.uniform(size=(len(windows), n_surrogates))
+    elif surrogate_method == 'epoch_shuffle':
+        if ev_samps is None:
+            raise ValueError('Must supply events for epoch_shuffle '
+                             'surrogates')
+        if min(len(i_ev) for i_ev in ev_groups) < 3:
+            # Two epochs have a single derangement, all surrogates are equal
+            raise ValueError('epoch_shuffle surrogates need at least three '
+                             'epochs per event type')
+        perms = np.zeros([n_surrogates, len(ev_samps)], dtype=int)
+        for i_surr in range(n_surrogates):
+            for i_ev in ev_groups:
+                perms[i_surr, i_ev] = i_ev[_derangement(len(i_ev), rng)]
+        return perms
+    else:
+        raise ValueError("surrogate_method must be 'time_shift' or "
+                         "'epoch_shuffle', got %s" % surrogate_method)
+
+
+def _derangement(n, rng):
+    """Draw a random permutation of ``n`` items without fixed points.
+
+    Permutations are drawn until one moves every item, which takes about
+    e (2.72) draws on average.
+    """
+    while True:
+        perm = rng.permutation(n)
+        if not np.any(perm == np.arange(n)):
+            return perm
+
+
+def _check_sliding_window(sliding_window, sfreq, tmin, tmax, pac_func):
+    """Convert a sliding window to samples and count the windows.
+
+    Returns the window length and step in samples, and the number of
+    windows between the single ``tmin`` and ``tmax``.
+    """
+    from ._accumulator import _accumulator_funcs
+    if len(tmin) != 1:
+        raise ValueError('tmin and tmax must be single values with '
+                         'sliding_window')
+    if len(sliding_window) != 2:
+        raise ValueError('sliding_window must be a (duration, step) tuple, '
+                         'got %s' % (sliding_window,))
+    for i_func in pac_func:
+        if i_func not in _accumulator_funcs:
+            raise ValueError('PAC function %s is not supported with '
+                             'sliding_window' % i_func)
+    n_window, n_step = [int(np.round(i_dur * sfreq))
+                        for i_dur in sliding_window]
+    n_span = int(np.round(tmax[0] * sfreq)) - int(np.round(tmin[0] * sfreq))
+    if n_window < 1 or n_step < 1 or n_window > n_span + 1:
+        raise ValueError('The duration of sliding_window must be between '
+                         'one sample and tmax - tmin, and its step at least '
+                         'one sample, got %s' % (sliding_window,))
+    return (n_window, n_step), (n_span + 1 - n_window) // n_step + 1
+
+
+def _check_pac_params(sfreq, n_times, f_phase, f_amp, ixs, pac_func, tmin,
+                      tmax, n_cycles_ph, n_cycles_am):
+    """Check and standardize the PAC parameters."""
     pac_func = np.atleast_1d(pac_func)
     for i_func in pac_func:
         if i_func not in _pac_funcs:
             raise ValueError("PAC function %s is not supported" % i_func)
-    n_pac_funcs = pac_func.shape[0]
     ixs = np.array(ixs, ndmin=2)
-    n_ch_pairs = ixs.shape[0]
     tmin = 0 if tmin is None else tmin
     tmin = np.atleast_1d(tmin)
-    n_pac_windows = len(tmin)
-    tmax = (data.shape[-1] - 1) / float(sfreq) if tmax is None else tmax
+    tmax = (n_times - 1) / float(sfreq) if tmax is None else tmax
     tmax = np.atleast_1d(tmax)
     f_phase = np.atleast_2d(f_phase)
     f_amp = np.atleast_2d(f_amp)
@@ -226,8 +775,6 @@ def _phase_amplitude_coupling(data, sfreq, f_phase, f_amp, ixs,
     if n_cycles_am.shape[0] == 1:
         n_cycles_am = np.repeat(n_cycles_am, f_amp.shape[0])
 
-    if data.ndim != 2:
-        raise ValueError('Data must be shape (n_channels, n_times)')
     if ixs.shape[1] != 2:
         raise ValueError('Indices must have have a 2nd dimension of length 2')
     if f_phase.shape[-1] != 2 or f_amp.shape[-1] != 2:
@@ -242,99 +789,267 @@ def _phase_amplitude_coupling(data, sfreq, f_phase, f_amp, ixs,
         if icyc.ndim > 1:
             raise ValueError("n_cycles must be 1-d, not {}d".format(icyc.ndim))
 
-    logger.info('Pre-filtering data and extracting phase/amplitude...')
     hi_phase = np.unique([i_func in _hi_phase_funcs for i_func in pac_func])
     if len(hi_phase) != 1:
         raise ValueError("Can't mix pac funcs that use both hi-freq phase/amp")
     hi_phase = bool(hi_phase[0])
-    data_ph, data_am, ix_map_ph, ix_map_am = _pre_filter_ph_am(
-        data, sfreq, ixs, f_phase, f_amp, hi_phase=hi_phase,
-        scale_amp_func=scale_amp_func, n_cycles_ph=n_cycles_ph,
-        n_cycles_am=n_cycles_am)
+    return (pac_func, ixs, tmin, tmax, f_phase, f_amp, n_cycles_ph,
+            n_cycles_am, hi_phase)
 
-    # So we know how big the PAC output will be
-    if events is None:
-        n_epochs = 1
-    elif concat_epochs is True:
-        if events.ndim == 1:
-            n_epochs = 1
-        else:
-            n_epochs = np.unique(events[:, -1]).shape[0]
-    else:
-        n_epochs = events.shape[0]
 
-    # Iterate through each pair of frequencies
-    ixs_freqs = product(range(data_ph.shape[1]), range(data_am.shape[1]))
-    ixs_freqs = np.atleast_2d(list(ixs_freqs))
+def _phase_amplitude_coupling_blocks(inst, picks, f_phase, f_amp, ixs,
+                                     pac_func='ozkurt', tmin=None, tmax=None,
+                                     n_cycles_ph=3, n_cycles_am=3,
+                                     block_duration=60., dtype=np.float64,
+                                     multirate=False, n_jobs=1):
+    """Compute PAC on Raw data in blocks of time.
 
-    freq_pac = np.array([[f_phase[ii], f_amp[jj]] for ii, jj in ixs_freqs])
-    n_f_pairs = len(ixs_freqs)
-    pac = np.zeros([n_pac_funcs, n_epochs, n_ch_pairs,
-                    n_f_pairs, n_pac_windows])
-    for i_f_pair, (ix_f_ph, ix_f_am) in enumerate(ixs_freqs):
-        # Second dimension is frequency
-        i_f_data_ph = data_ph[:, ix_f_ph, ...]
-        i_f_data_am = data_am[:, ix_f_am, ...]
-
-        # Redefine indices to match the new data arrays
-        ixs_new = [(ix_map_ph[i], ix_map_am[j]) for i, j in ixs]
-        i_f_data_ph = mne.io.RawArray(
-            i_f_data_ph, mne.create_info(i_f_data_ph.shape[0], sfreq))
-        i_f_data_am = mne.io.RawArray(
-            i_f_data_am, mne.create_info(i_f_data_am.shape[0], sfreq))
-
-        # Turn into Epochs if we have defined events
-        if events is not None:
-            i_f_data_ph = _raw_to_epochs_mne(i_f_data_ph, events, tmin, tmax)
-            i_f_data_am = _raw_to_epochs_mne(i_f_data_am, events, tmin, tmax)
-
-        # Data is either Raw or Epochs
-        pbar = ProgressBar(n_epochs)
-        for itime, (i_tmin, i_tmax) in enumerate(zip(tmin, tmax)):
-            # Pull times of interest
-            with warnings.catch_warnings():  # To suppress a depracation
-                warnings.simplefilter("ignore")
-                # Not sure how to do this w/o copying
-                i_t_data_am = i_f_data_am.copy().crop(i_tmin, i_tmax)
-                i_t_data_ph = i_f_data_ph.copy().crop(i_tmin, i_tmax)
-
-            if concat_epochs is True:
-                # Iterate through each event type and hstack
-                con_data_ph = []
-                con_data_am = []
-                for i_ev in i_t_data_am.event_id.keys():
-                    con_data_ph.append(np.hstack(i_t_data_ph[i_ev]._data))
-                    con_data_am.append(np.hstack(i_t_data_am[i_ev]._data))
-                i_t_data_ph = np.vstack(con_data_ph)
-                i_t_data_am = np.vstack(con_data_am)
-            else:
-                # Just pull all epochs separately
-                i_t_data_ph = i_t_data_ph._data
-                i_t_data_am = i_t_data_am._data
-            # Now make sure that inputs to the loop are ep x chan x time
-            if i_t_data_am.ndim == 2:
-                i_t_data_ph = i_t_data_ph[np.newaxis, ...]
-                i_t_data_am = i_t_data_am[np.newaxis, ...]
-            # Loop through epochs (or epoch grps), each index pair, and funcs
-            data_iter = zip(i_t_data_ph, i_t_data_am)
-            for iep, (ep_ph, ep_am) in enumerate(data_iter):
-                for iix, (i_ix_ph, i_ix_am) in enumerate(ixs_new):
-                    for ix_func, i_pac_func in enumerate(pac_func):
-                        func = getattr(ppac, i_pac_func)
-                        pac[ix_func, iep, iix, i_f_pair, itime] = func(
-                            ep_ph[i_ix_ph], ep_am[i_ix_am],
-                            f_phase, f_amp, filterfn=False)
-            pbar.update_with_increment_value(1)
+    ``ixs`` index into ``picks``. Only the picked channels of one block (plus
+    the overlap) are read at a time, and the sufficient statistics of each
+    PAC function are accumulated over blocks and windows. With ``n_jobs``,
+    each job handles a contiguous run of blocks.
+    """
+    sfreq = inst.info['sfreq']
+    n_times = inst.n_times
+    (pac_func, ixs, tmin, tmax, f_phase, f_amp, n_cycles_ph, n_cycles_am,
+     hi_phase) = _check_pac_params(sfreq, n_times, f_phase, f_amp, ixs,
+                                   pac_func, tmin, tmax, n_cycles_ph,
+                                   n_cycles_am)
+    _, _, windows, _ = _epoch_sample_ixs(None, tmin, tmax, sfreq, n_times)
+    n_block = int(np.round(block_duration * sfreq))
+    if n_block < 1:
+        raise ValueError('block_duration must be at least one sample')
+
+    # Overlap blocks by the longest filter so edge artifacts can be dropped
+    n_taps_ph, n_taps_am = [
+        max(len(_band_pass_taps(i_f, sfreq, i_cyc))
+            for i_f, i_cyc in zip(i_fs, i_cycs))
+        for i_fs, i_cycs in [(f_phase, n_cycles_ph), (f_amp, n_cycles_am)]]
+    if hi_phase is True:
+        n_taps_am += n_taps_ph
+    n_pad = max(n_taps_ph, n_taps_am)
+
+    n_ph, n_am = f_phase.shape[0], f_amp.shape[0]
+    freq_pac = np.array([[i_f_ph, i_f_am] for i_f_ph, i_f_am
+                         in product(f_phase, f_amp)])
+    first, last = windows[:, 0].min(), windows[:, 1].max()
+    starts = np.arange(first, last, n_block)
+    logger.info('Computing PAC in %d blocks...' % len(starts))
+
+    # Each job accumulates a contiguous run of blocks, then we merge
+    parallel, my_pac_blocks, n_jobs = parallel_func(_pac_blocks, n_jobs)
+    out = parallel(my_pac_blocks(
+        inst, picks, i_starts, n_block, last, n_pad, windows, sfreq, ixs,
+        f_phase, f_amp, pac_func, hi_phase, n_cycles_ph, n_cycles_am,
+        _check_dtype(dtype), multirate)
+        for i_starts in np.array_split(starts, n_jobs) if len(i_starts))
+    accumulators = out[0]
+    for i_accumulators in out[1:]:
+        for i_acc, i_new in zip(accumulators, i_accumulators):
+            i_acc.merge(i_new)
+
+    pac = np.zeros([len(pac_func), 1, ixs.shape[0], n_ph * n_am,
+                    len(windows)])
+    for ix_func in range(len(pac_func)):
+        for itime in range(len(windows)):
+            pac[ix_func, 0, :, :, itime] = accumulators[
+                ix_func * len(windows) + itime].compute().reshape(
+                ixs.shape[0], n_ph * n_am)
     if pac.shape[0] == 1:
         pac = pac[0]
-    if return_data:
-        return pac, freq_pac, data_ph, data_am
-    else:
-        return pac, freq_pac
+    return pac, freq_pac
+
+
+def _pac_blocks(inst, picks, starts, n_block, last, n_pad, windows, sfreq,
+                ixs, f_phase, f_amp, pac_func, hi_phase, n_cycles_ph,
+                n_cycles_am, dtype=np.float64, multirate=False):
+    """Accumulate PAC over the blocks of Raw data beginning at ``starts``.
 
+    Returns one PACAccumulator per PAC function and window, in that order.
+    """
+    n_times = inst.n_times
+    accumulators = [PACAccumulator(i_pac_func) for i_pac_func in pac_func
+                    for _ in windows]
+    for start in starts:
+        stop = min(start + n_block, last)
+        read_start = max(start - n_pad, 0)
+        read_stop = min(stop + n_pad, n_times)
+        data = inst[picks, read_start:read_stop][0]
+        data_ph, data_am, ix_map_ph, ix_map_am = _pre_filter_ph_am(
+            data, sfreq, ixs, f_phase, f_amp, hi_phase=hi_phase,
+            n_cycles_ph=n_cycles_ph, n_cycles_am=n_cycles_am, dtype=dtype,
+            multirate=multirate)
+        # Broadcast to (n_ch_pairs, n_bands_phase, n_bands_amp, n_times)
+        data_ph = data_ph[[ix_map_ph[i] for i in ixs[:, 0]]][:, :, np.newaxis]
+        data_am = data_am[[ix_map_am[i] for i in ixs[:, 1]]][:, np.newaxis]
+
+        for itime, (w_start, w_stop) in enumerate(windows):
+            i_start = max(start, w_start) - read_start
+            i_stop = min(stop, w_stop) - read_start
+            if i_stop <= i_start:
+                continue
+            for ix_func in range(len(pac_func)):
+                accumulators[ix_func * len(windows) + itime].update(
+                    data_ph[..., i_start:i_stop],
+                    data_am[..., i_start:i_stop])
+    return accumulators
+
+
+def _pac_freq_pair(data_ph, data_am, ixs, pac_func, samp_ixs, ev_groups,
+                   windows, concat_epochs, n_epochs, surrogate_method=None,
+                   surr_ixs=None, sliding_window=None, timer=None):
+    """Compute PAC for a single frequency pair and a set of channel pairs.
+
+    ``data_ph`` and ``data_am`` are the (n_channels, n_times) phase and
+    amplitude signals for this frequency pair, and ``ixs`` indexes into
+    their rows. ``samp_ixs`` holds the start samples of the epochs of each
+    window (see `_window_sample_ixs`). Returns an array of shape
+    (n_out, n_pac_funcs, n_epochs, n_ch_pairs, n_pac_windows), where the
+    output is the PAC, followed by its z-score and p-value if ``surr_ixs``
+    (see `_draw_surrogates`) is not None. If ``sliding_window`` (the window
+    length and step in samples) is not None, ``windows`` is a single span
+    and the last axis of the output holds the windows sliding through it.
+
+    The time spent in each stage is added to ``timer`` (an instance of
+    _PACTimer) if not None, and the timer is returned with the output.
+    """
+    from ..externals.pacpy import pac as ppac
+    timer = _NoTimer() if timer is None else timer
+    if sliding_window is not None:
+        start, stop = windows[0]
+        with timer('epoch'):
+            ep_ph = _gather_epochs(data_ph, ixs[:, 0], samp_ixs[0],
+                                   stop - start)
+            ep_am = _gather_epochs(data_am, ixs[:, 1], samp_ixs[0],
+                                   stop - start)
+        n_window, n_step = sliding_window
+        pac = np.zeros([1, len(pac_func), n_epochs, len(ixs),
+                        (stop - start - n_window) // n_step + 1])
+        with timer('metric'):
+            for ix_func, i_pac_func in enumerate(pac_func):
+                pac[0, ix_func, :len(ep_ph)] = ppac._pac_sliding(
+                    ep_ph, ep_am, i_pac_func, n_window, n_step)
+        return pac, timer
+
+    n_out = 1 if surr_ixs is None else 3
+    pac = np.zeros([n_out, len(pac_func), n_epochs, len(ixs), len(windows)])
+    funcs = [getattr(ppac, '_%s_batch' % i_pac_func)
+             for i_pac_func in pac_func]
+
+    pbar = ProgressBar(len(windows))
+    for itime, (start, stop) in enumerate(windows):
+        i_samp_ixs = samp_ixs[itime]
+        if concat_epochs is True:
+            # Gather the epochs of each event type end to end in time
+            if surr_ixs is not None and surrogate_method == 'epoch_shuffle':
+                with timer('epoch'):
+                    ep_ph = _gather_epochs(data_ph, ixs[:, 0], i_samp_ixs,
+                                           stop - start)
+            for i_grp, i_ev in enumerate(ev_groups):
+                i_grp_ixs = i_samp_ixs if isinstance(i_samp_ixs, slice) \
+                    else i_samp_ixs[i_ev]
+                with timer('epoch'):
+                    grp_ph = _gather_epochs(data_ph, ixs[:, 0], i_grp_ixs,
+                                            stop - start, concat=True)
+                    grp_am = _gather_epochs(data_am, ixs[:, 1], i_grp_ixs,
+                                            stop - start, concat=True)
+                with timer('metric'):
+                    for ix_func, func in enumerate(funcs):
+                        pac[0, ix_func, i_grp, :, itime] = func(grp_ph,
+                                                                grp_am)
+                if surr_ixs is None:
+                    continue
+                with timer('surrogates'):
+                    if surrogate_method == 'time_shift':
+                        _pac_surrogate_stats(
+                            pac[:, :, i_grp, :, itime], pac_func, grp_ph,
+                            grp_am, shifts=surr_ixs[itime] * grp_ph.shape[-1])
+                    else:
+                        _pac_surrogate_stats(
+                            pac[:, :, i_grp, :, itime], pac_func, ep_ph,
+                            grp_am, perms=surr_ixs[:, i_ev], concat=True)
+        else:
+            # Gather (epochs, channel pairs, times) arrays and reduce each PAC
+            # function over time for all epochs and channel pairs at once
+            with timer('epoch'):
+                ep_ph = _gather_epochs(data_ph, ixs[:, 0], i_samp_ixs,
+                                       stop - start)
+                ep_am = _gather_epochs(data_am, ixs[:, 1], i_samp_ixs,
+                                       stop - start)
+            n_ep = len(ep_ph)
+            with timer('metric'):
+                for ix_func, func in enumerate(funcs):
+                    pac[0, ix_func, :n_ep, :, itime] = func(ep_ph, ep_am)
+            if surr_ixs is not None:
+                with timer('surrogates'):
+                    if surrogate_method == 'time_shift':
+                        _pac_surrogate_stats(
+                            pac[:, :, :n_ep, :, itime], pac_func, ep_ph,
+                            ep_am, shifts=surr_ixs[itime] * (stop - start))
+                    else:
+                        _pac_surrogate_stats(
+                            pac[:, :, :n_ep, :, itime], pac_func, ep_ph,
+                            ep_am, perms=surr_ixs)
+        pbar.update_with_increment_value(1)
+    return pac, timer
+
+
+def _pac_surrogate_stats(pac, pac_func, data_ph, data_am, shifts=None,
+                         perms=None, concat=False, n_batch=10):
+    """Fill the z-scores and p-values of PAC compared to surrogates in place.
+
+    ``pac`` has shape (3, n_pac_funcs, ...), with the PAC values already
+    in ``pac[0]``. Surrogates either circularly shift ``data_ph`` by each of
+    ``shifts``, or pair ``data_am`` with the epochs (first axis) of
+    ``data_ph`` given by each row of ``perms``, concatenated in time if
+    ``concat`` is True. Shuffled surrogates are computed ``n_batch`` at a
+    time to bound memory.
+    """
+    from ..externals.pacpy import pac as ppac
+    pac_surr = np.zeros(pac.shape[1:] + (len(shifts if perms is None
+                                             else perms),))
+    for ix_func, i_pac_func in enumerate(pac_func):
+        if perms is None:
+            pac_surr[ix_func] = ppac._pac_shifted(
+                data_ph, data_am, i_pac_func, shifts.astype(int))
+            continue
+        func = getattr(ppac, '_%s_batch' % i_pac_func)
+        for start in range(0, len(perms), n_batch):
+            surr_ph = data_ph[perms[start:start + n_batch]]
+            if concat is True:
+                # (n_batch, n_epochs, n_ch_pairs, n_times) to
+                # (n_batch, n_ch_pairs, n_epochs * n_times)
+                surr_ph = surr_ph.transpose(0, 2, 1, 3).reshape(
+                    surr_ph.shape[0], surr_ph.shape[2], -1)
+            i_surr = func(surr_ph, data_am)
+            pac_surr[ix_func, ..., start:start + n_batch] = np.rollaxis(
+                i_surr, 0, i_surr.ndim)
+
+    pac_obs = pac[0][..., np.newaxis]
+    pac[1] = (pac[0] - pac_surr.mean(-1)) / pac_surr.std(-1)
+    pac[2] = (1. + np.sum(pac_surr >= pac_obs, axis=-1)) / \
+        (1. + pac_surr.shape[-1])
+
+
+def _epoch_sample_ixs(events, tmin, tmax, sfreq, n_times):
+    """Convert events and PAC windows to sample indices.
+
+    Returns the event samples (None if there are no events), a list with
+    the indices of the events for each event type, a (n_pac_windows, 2)
+    array with the start / stop samples of each window, and the indices of
+    the kept events in ``events`` (None if there are no events). If there
+    are events, windows are relative to each event sample. Events whose full
+    epoch would extend beyond the data are dropped, and the other outputs
+    only index the kept events.
+    """
+    windows = np.array([[int(np.round(i_tmin * sfreq)),
+                         int(np.round(i_tmax * sfreq)) + 1]
+                        for i_tmin, i_tmax in zip(tmin, tmax)])
+    if events is None:
+        if windows.min() < 0 or windows.max() > n_times:
+            raise ValueError('tmin and tmax must be within the data limits')
+        return None, [np.array([0])], windows, None
 
-def _raw_to_epochs_mne(raw, events, tmin, tmax):
-    """Convert Raw data to Epochs w/ some time checks."""
     events = np.atleast_1d(events)
     if events.ndim == 1:
         events = np.vstack([events, np.zeros_like(events),
@@ -343,17 +1058,98 @@ def _raw_to_epochs_mne(raw, events, tmin, tmax):
         raise ValueError('events have incorrect number of dimensions')
     if events.shape[-1] != 3:
         raise ValueError('events have incorrect number of columns')
-    # Convert to Epochs using the event times
-    tmin_all = np.min(tmin)
-    tmax_all = np.max(tmax) + (1. / raw.info['sfreq'])
-    return mne.Epochs(raw, events, tmin=tmin_all, tmax=tmax_all, preload=True,
-                      baseline=None)
+
+    # Drop events whose (padded) epoch would be cut off by the data limits
+    ep_start = windows[:, 0].min()
+    ep_stop = int(np.round((np.max(tmax) + 1. / sfreq) * sfreq)) + 1
+    msk_keep = np.logical_and(events[:, 0] + ep_start >= 0,
+                              events[:, 0] + ep_stop <= n_times)
+    if not msk_keep.all():
+        logger.info('Dropping %d events whose windows extend beyond the '
+                    'data limits, their PAC is NaN' % (~msk_keep).sum())
+        events = events[msk_keep]
+    ev_groups = [np.where(events[:, -1] == i_id)[0]
+                 for i_id in np.unique(events[:, -1])]
+    return events[:, 0], ev_groups, windows, np.where(msk_keep)[0]
+
+
+def _epochs_sample_ixs(events, tmin, tmax, sfreq, n_epochs, n_times):
+    """Sample indices of epochs laid end to end in time.
+
+    Same outputs as `_epoch_sample_ixs`, for (n_epochs, n_channels, n_times)
+    data whose filtered epochs are concatenated in time (see
+    `_pre_filter_ph_am`). Epochs are grouped by the event types of
+    ``events`` if given, and windows are relative to the start of each
+    epoch.
+    """
+    _, _, windows, _ = _epoch_sample_ixs(None, tmin, tmax, sfreq, n_times)
+    if events is None:
+        ev_ids = np.ones(n_epochs, dtype=int)
+    else:
+        ev_ids = np.atleast_2d(events)[:, -1]
+        if len(ev_ids) != n_epochs:
+            raise ValueError('There must be one event per epoch, got %d '
+                             'events and %d epochs' % (len(ev_ids), n_epochs))
+    ev_groups = [np.where(ev_ids == i_id)[0] for i_id in np.unique(ev_ids)]
+    return np.arange(n_epochs) * n_times, ev_groups, windows, None
+
+
+def _window_sample_ixs(ev_samps, windows):
+    """First sample of the epochs of each PAC window.
+
+    Returns one (n_epochs,) array of start samples per window, or a slice if
+    there are no events. They are computed once and shared by all frequency
+    pairs and PAC functions (see `_gather_epochs`).
+    """
+    if ev_samps is None:
+        return [slice(start, stop) for start, stop in windows]
+    return [ev_samps + start for start, _ in windows]
+
+
+def _gather_epochs(data, ch_ixs, samp_ixs, n_times, concat=False):
+    """Gather epochs of ``n_times`` samples out of 2D data.
+
+    ``samp_ixs`` is a slice, or the first sample of each epoch (see
+    `_window_sample_ixs`). Returns an array of shape
+    (n_epochs, n_ch_ixs, n_times), or (n_ch_ixs, n_epochs * n_times) with
+    the epochs end to end in time if ``concat`` is True. Channels and epochs
+    are gathered with a single fancy-indexing operation on a strided view
+    of all the windows of ``n_times`` samples, so that each epoch is copied
+    as a block.
+    """
+    if isinstance(samp_ixs, slice):
+        out = data[np.newaxis, ch_ixs, samp_ixs]
+        return out[0] if concat else out
+    windows = as_strided(
+        data, shape=(data.shape[0], data.shape[1] - n_times + 1, n_times),
+        strides=data.strides + data.strides[-1:], writeable=False)
+    if concat is True:
+        out = windows[ch_ixs[:, np.newaxis], samp_ixs[np.newaxis, :]]
+        return out.reshape(len(ch_ixs), -1)
+    return windows[ch_ixs[np.newaxis, :], samp_ixs[:, np.newaxis]]
 
 
 def _pre_filter_ph_am(data, sfreq, ixs, f_ph, f_am, n_cycles_ph=3,
                       n_cycles_am=3, hi_phase=False, scale_amp_func=None,
-                      kws_filt=None):
-    """Filter for phase/amp only once for each channel."""
+                      kws_filt=None, cache_dir=None, filter_cache=None,
+                      dtype=np.float64, multirate=False, decim=1):
+    """Filter for phase/amp only once for each channel.
+
+    If ``cache_dir`` is not None, the phase and amplitude are written to
+    float32 memmaps in ``cache_dir`` (see `_cache_array`) instead of being
+    kept in memory. If ``filter_cache`` (an instance of PACFilterCache) is
+    not None, channels that were already filtered are read from it. Filtering
+    is done in the precision of ``dtype``. If ``multirate`` is True, phases
+    are computed at a lower rate and interpolated (see `_filter_and_hilbert`).
+    Only every ``decim``-th sample of the outputs is kept.
+
+    If ``data`` is (n_epochs, n_channels, n_times), all the epochs of all
+    the channels are filtered in one batch, each on its own, and the outputs
+    are (n_channels, n_freqs, n_epochs * n_times) with the epochs laid end
+    to end in time. With ``cache_dir``, each epoch is instead filtered
+    directly into its time slice of the memmaps, so the filtered epochs are
+    never all held in memory.
+    """
     from ..externals.pacpy.pac import _range_sanity
 
     kws_filt = dict() if kws_filt is None else kws_filt
@@ -367,19 +1163,76 @@ def _pre_filter_ph_am(data, sfreq, ixs, f_ph, f_am, n_cycles_ph=3,
     for i_f_am in f_am:
         _range_sanity(f_ph[0], i_f_am)
 
-    # Output will be (n_chan, n_freqs, n_times). Operates in place.
-    data_ph = data[ix_ph, :]
-    out_ph = _filter_and_hilbert(data_ph, sfreq, f_ph, n_cycles_ph)
-    out_ph = np.angle(out_ph)
-
-    data_am = data[ix_am, :]
-    out_am = _filter_and_hilbert(data_am, sfreq, f_am, n_cycles_am)
-    out_am = np.abs(out_am)
-    if hi_phase is True:
-        # We assume f_ph has len(1), multiple freqs not supported w/ plv
-        out_am = _filter_and_hilbert(out_am, sfreq, f_ph, n_cycles_ph,
-                                     inplace=True)
-        out_am = np.angle(out_am)
+    def _filter_ph(data_ph, out):
+        return _filter_and_hilbert(data_ph, sfreq, f_ph, n_cycles_ph,
+                                   transform=np.angle, out=out, dtype=dtype,
+                                   multirate=multirate, decim=decim)
+
+    def _filter_am(data_am, out):
+        if hi_phase is True:
+            # We assume f_ph has len(1), multiple freqs not supported w/ plv.
+            # The envelope is filtered again at the full rate, in place.
+            env = _filter_and_hilbert(data_am, sfreq, f_am, n_cycles_am,
+                                      transform=np.abs, dtype=dtype,
+                                      out=out if decim == 1 else None)
+            return _filter_and_hilbert(env, sfreq, f_ph, n_cycles_ph,
+                                       inplace=True, transform=np.angle,
+                                       out=out, dtype=dtype,
+                                       multirate=multirate, decim=decim)
+        return _filter_and_hilbert(data_am, sfreq, f_am, n_cycles_am,
+                                   transform=np.abs, out=out, dtype=dtype,
+                                   decim=decim)
+
+    # Output will be (n_chan, n_freqs, n_epochs * n_times_decim)
+    n_times = data.shape[-1]
+    n_times_decim = (n_times - 1) // decim + 1
+    n_epochs = data.shape[0] if data.ndim == 3 else 1
+    out_ph = _cache_array(cache_dir, 'phase',
+                          (len(ix_ph), len(f_ph), n_epochs * n_times_decim))
+    out_am = _cache_array(cache_dir, 'amplitude',
+                          (len(ix_am), len(f_am), n_epochs * n_times_decim))
+    if filter_cache is None:
+        def _filter(data_ph, data_am, out_ph, out_am):
+            return _filter_ph(data_ph, out_ph), _filter_am(data_am, out_am)
+    else:
+        # Everything that the filtered signals depend on, for the cache keys
+        params_ph = [_filter_params(sfreq, f_ph, n_cycles_ph, n_times)]
+        params_am = [_filter_params(sfreq, f_am, n_cycles_am, n_times)]
+        if multirate is True:
+            params_ph.append('multirate')
+        if hi_phase is True:
+            params_am += params_ph
+        if decim > 1:
+            params_ph += ['decim', decim]
+            params_am += ['decim', decim]
+        dtype = np.dtype(dtype)
+
+        def _filter(data_ph, data_am, out_ph, out_am):
+            return (_filter_with_cache(filter_cache, data_ph,
+                                       ['phase', dtype.str] + params_ph,
+                                       _filter_ph, out_ph, len(f_ph), dtype,
+                                       n_times_decim),
+                    _filter_with_cache(filter_cache, data_am,
+                                       ['amplitude', dtype.str] + params_am,
+                                       _filter_am, out_am, len(f_am), dtype,
+                                       n_times_decim))
+
+    if n_epochs == 1:
+        out_ph, out_am = _filter(data[ix_ph], data[ix_am], out_ph, out_am)
+    elif cache_dir is not None:
+        # Filter each epoch straight into its time slice of the memmaps
+        for i_ep in range(n_epochs):
+            i_times = slice(i_ep * n_times_decim, (i_ep + 1) * n_times_decim)
+            _filter(data[i_ep, ix_ph], data[i_ep, ix_am],
+                    out_ph[..., i_times], out_am[..., i_times])
+    else:
+        # Stack the epochs as channels, so they're all filtered in one pass,
+        # into new arrays that are then laid end to end in time
+        out_filt_ph, out_filt_am = _filter(
+            data[:, ix_ph].reshape(-1, n_times),
+            data[:, ix_am].reshape(-1, n_times), None, None)
+        out_ph = _epochs_to_time(out_filt_ph, n_epochs)
+        out_am = _epochs_to_time(out_filt_am, n_epochs)
 
     # New index mapping for unique channels
     ix_map_ph = dict((ix, i) for i, ix in enumerate(ix_ph))
@@ -391,6 +1244,88 @@ def _pre_filter_ph_am(data, sfreq, ixs, f_ph, f_am, n_cycles_ph=3,
     return out_ph, out_am, ix_map_ph, ix_map_am
 
 
+def _epochs_to_time(data, n_epochs, out=None):
+    """Lay the epochs of filtered signals end to end in time.
+
+    ``data`` is (n_epochs * n_channels, n_freqs, n_times), with epochs
+    stacked as channels. Returns (n_channels, n_freqs, n_epochs * n_times),
+    written into ``out`` if not None.
+    """
+    _, n_freqs, n_times = data.shape
+    data = data.reshape(n_epochs, -1, n_freqs, n_times).transpose(1, 2, 0, 3)
+    if out is None:
+        out = np.empty(data.shape[:2] + (n_epochs * n_times,), data.dtype)
+    out.reshape(data.shape)[:] = data
+    return out
+
+
+def _filter_params(sfreq, frequencies, n_cycles, n_times):
+    """Concatenate the parameters and taps of a filter bank into an array."""
+    taps = [_band_pass_taps(f_range, sfreq, n_cyc, n_times)
+            for f_range, n_cyc in zip(frequencies, n_cycles)]
+    return np.concatenate([[sfreq], np.ravel(frequencies), n_cycles] + taps)
+
+
+def _filter_with_cache(filter_cache, data, params, func, out, n_freqs,
+                       dtype=np.float64, n_times=None):
+    """Filter each channel of ``data`` with ``func``, using a PACFilterCache.
+
+    ``func(data, out)`` filters (n_channels, n_times) data into ``out``
+    (or a new array if None), of shape (n_channels, n_freqs, n_times), where
+    ``n_times`` defaults to the length of ``data``. Channels are looked up
+    by a hash of their data and ``params``, and only the missing channels
+    are filtered (in one call) and added to the cache.
+    """
+    if out is None:
+        n_times = data.shape[-1] if n_times is None else n_times
+        out = np.zeros([data.shape[0], n_freqs, n_times], dtype)
+    keys = [filter_cache.key(i_data, *params) for i_data in data]
+    missing = []
+    for ii, key in enumerate(keys):
+        cached = filter_cache.get(key)
+        if cached is None:
+            missing.append(ii)
+        else:
+            out[ii] = cached
+    logger.info('Read %d of %d channels from the filter cache'
+                % (len(keys) - len(missing), len(keys)))
+    if len(missing) > 0:
+        out_missing = func(data[missing], None)
+        for ii, i_out in zip(missing, out_missing):
+            out[ii] = i_out
+            filter_cache.put(keys[ii], i_out)
+    return out
+
+
+def _cache_array(cache_dir, name, shape):
+    """Create a float32 memmap for filtered signals in ``cache_dir``.
+
+    Returns None if ``cache_dir`` is None, so that the arrays are allocated
+    in memory. The file is named after ``name`` and is deleted by
+    `_clear_cache_array`.
+    """
+    if cache_dir is None:
+        return None
+    if not op.isdir(cache_dir):
+        raise ValueError('cache_dir must be an existing directory, got %s'
+                         % cache_dir)
+    fid, fname = tempfile.mkstemp(prefix='pac_%s_' % name, suffix='.dat',
+                                  dir=cache_dir)
+    os.close(fid)
+    logger.info('Caching %s of shape %s in %s' % (name, shape, fname))
+    return np.memmap(fname, dtype=np.float32, mode='w+', shape=shape)
+
+
+def _clear_cache_array(arr):
+    """Delete the file of a memmap created by `_cache_array`."""
+    if isinstance(arr, np.memmap) and arr.filename is not None:
+        try:
+            # The data stay readable until the memmap is closed
+            os.remove(arr.filename)
+        except OSError:
+            logger.info('Could not delete cache file %s' % arr.filename)
+
+
 def _raw_to_epochs_array(x, sfreq, events, tmin, tmax):
     """Aux function to create epochs from a 2D array"""
     if events.ndim != 1:
@@ -420,26 +1355,194 @@ def _raw_to_epochs_array(x, sfreq, events, tmin, tmax):
     return epochs, times, msk_keep
 
 
-def _filter_and_hilbert(data, sfreq, frequencies, n_cycles, inplace=False):
+def _filter_and_hilbert(data, sfreq, frequencies, n_cycles, inplace=False,
+                        transform=None, out=None, dtype=np.float64,
+                        multirate=False, decim=1):
+    """Band-pass filter and Hilbert transform data with an FFT filter bank.
+
+    Each channel is transformed once. Its spectrum is multiplied by the
+    zero-phase response of every band (the squared magnitude response of the
+    FIR filter, as with ``filtfilt``) combined with the one-sided mask of the
+    analytic signal, and each band takes one inverse FFT. If ``inplace`` is
+    True, ``data`` is (n_channels, n_freqs, n_times) and row ``jj`` of each
+    channel is filtered with ``frequencies[jj]``.
+
+    If ``transform`` is not None (e.g., ``np.angle``), it is applied to the
+    analytic signal of each band as soon as it is computed, and the real
+    output is written band by band into ``out`` if given (e.g., a memmap),
+    so the full complex output is never held in memory. All computations
+    are done in the precision of ``dtype`` (float32 or float64).
+
+    If ``multirate`` is True, ``transform`` must be ``np.angle``. The phase
+    of each band is then computed at a lower rate (see `_band_decim`), with
+    a shorter inverse FFT of the low frequencies of the spectrum, and its
+    unwrapped phase is linearly interpolated back to the full rate.
+
+    Only every ``decim``-th sample of the output is kept, so that the output
+    has ``(n_times - 1) // decim + 1`` samples.
+    """
+    dtype = _check_dtype(dtype)
+    dtype_complex = np.result_type(dtype, np.complex64)
+    if multirate is True and transform is not np.angle:
+        raise ValueError('multirate is only supported for phase')
     if inplace is True:
         # Assume data is (n_chan, n_freqs, n_times)
         n_channels, n_freqs, n_times = data.shape
-        out = data
     else:
         n_freqs = frequencies.shape[0]
         n_channels, n_times = data.shape
         data = data[:, np.newaxis, :]  # To ensure shapes are always consistent
-        out = np.zeros([n_channels, n_freqs, n_times])
-    # Filtering in place
-    for ii in range(n_channels):
-        for jj, n_cyc in zip(range(n_freqs), n_cycles):
-            out[ii, jj] = _band_pass_pac(data[ii, 0], frequencies[jj], sfreq,
-                                         n_cycles=n_cyc)
-    n_hil = int(2 ** np.ceil(np.log2(n_times)))
-    out = hilbert(out, N=n_hil)[..., :n_times]
+    taps = [_band_pass_taps(f_range, sfreq, n_cyc, n_times)
+            for f_range, n_cyc in zip(frequencies, n_cycles)]
+
+    # Zero-pad enough that the zero-phase filters don't wrap around
+    n_taps_max = max(len(i_taps) for i_taps in taps)
+    n_fft = next_fast_len(n_times + n_taps_max - 1)
+    responses = _band_responses(taps, n_fft).astype(dtype)
+    data_fft = rfft(np.asarray(data, dtype=dtype), n_fft)
+
+    if out is None:
+        out = np.zeros([n_channels, n_freqs, (n_times - 1) // decim + 1],
+                       dtype=dtype if transform is not None else
+                       dtype_complex)
+    spectrum = np.zeros([n_channels, n_fft], dtype=dtype_complex)
+    for jj in range(n_freqs):
+        i_data_fft = data_fft[:, jj] if inplace is True else data_fft[:, 0]
+        band_decim = 1 if multirate is False else _band_decim(
+            responses[jj], n_fft, sfreq, frequencies[jj][1])
+        # Decimate by keeping the lowest frequencies of the spectrum
+        n_band = n_fft // band_decim
+        n_keep = min(n_band, responses.shape[-1])
+        spectrum[:, :n_keep] = i_data_fft[:, :n_keep] * responses[jj, :n_keep]
+        band = ifft(spectrum[:, :n_band])
+        if np.isnan(band).any():
+            raise RuntimeError(
+                'Filtered signal contains nans. Adjust filter parameters.')
+        if n_fft // n_band > 1:
+            band_decim = n_fft // n_band
+            n_band_times = min((n_times - 1) // band_decim + 2, n_band)
+            out[:, jj] = _interp_phase(np.angle(band[:, :n_band_times]),
+                                       band_decim, n_times)[:, ::decim]
+        else:
+            band = band[:, :n_times:decim]
+            out[:, jj] = band if transform is None else transform(band)
     return out
 
 
+def _band_decim(response, n_fft, sfreq, f_high, n_oversample=32, tol=1e-8):
+    """Largest decimation factor for the analytic signal of a band.
+
+    ``response`` is the response of the band on the rfft grid of ``n_fft``
+    points (see `_band_responses`). The decimated signal keeps all the
+    frequencies where the response is above ``tol`` times its maximum, so
+    they don't alias, and samples the upper edge ``f_high`` of the band
+    ``n_oversample`` times per cycle, so that the phase can be linearly
+    interpolated. The factor divides ``n_fft``, so that decimated samples
+    fall on the original ones.
+    """
+    k_max = np.nonzero(response > tol * response.max())[0].max()
+    n_min = max(k_max + 1,
+                int(np.ceil(n_oversample * f_high * n_fft / float(sfreq))))
+    return max(decim for decim in range(1, max(n_fft // n_min, 1) + 1)
+               if n_fft % decim == 0)
+
+
+def _interp_phase(phase, decim, n_times):
+    """Linearly interpolate the unwrapped phase of decimated signals.
+
+    ``phase`` is (n_channels, n_decim), sampled every ``decim`` samples.
+    Returns the (n_channels, n_times) phase, wrapped to [-pi, pi).
+    """
+    phase = np.unwrap(phase, axis=-1)
+    weights = np.arange(decim, dtype=phase.dtype) / decim
+    out = np.diff(phase, axis=-1)[:, :, np.newaxis] * weights
+    out += phase[:, :-1, np.newaxis] + np.pi
+    out = out.reshape(len(out), -1)[:, :n_times]
+    np.mod(out, 2 * np.pi, out=out)
+    out -= np.pi
+    return out
+
+
+def _check_decim(decim, sfreq, f_phase, f_amp, n_cycles_ph, n_cycles_am):
+    """Check the decimation factor of the PAC metrics, or choose it."""
+    if isinstance(decim, str):
+        if decim != 'auto':
+            raise ValueError("decim must be a positive int or 'auto', got %s"
+                             % (decim,))
+        return _auto_decim(sfreq, f_phase, f_amp, n_cycles_ph, n_cycles_am)
+    if int(decim) != decim or decim < 1:
+        raise ValueError("decim must be a positive int or 'auto', got %s"
+                         % (decim,))
+    return int(decim)
+
+
+def _auto_decim(sfreq, f_phase, f_amp, n_cycles_ph, n_cycles_am, tol=1e-4):
+    """Largest decimation factor that keeps the PAC summands band-limited.
+
+    The support of a band is where the response of its filter (see
+    `_band_responses`) is above ``tol`` times its maximum. Phases oscillate
+    up to ``f_top``, the top of the support of the phase bands, and
+    amplitude envelopes up to ``width``, the width of the support of the
+    amplitude bands. The PAC metrics sum products of these signals, e.g.
+    ``amp * cos(phase)``, which oscillate up to ``f_max = f_top + width``.
+    The decimated rate is kept above ``2 * f_max``, so these products are
+    sampled above their Nyquist rate. Squared terms (e.g., ``amp ** 2``
+    or ``cos(phase) ** 2``) oscillate up to ``2 * width`` or
+    ``2 * f_top``, which are below the decimated rate, so none of the
+    summands aliases onto the sums.
+
+    No low-pass filter is applied before decimating: the filtered signals
+    are decimated right after the band-pass filters, which are the
+    anti-aliasing filters of the analytic signals. The wrapped phase and
+    the envelope are not strictly band-limited, and low-pass filtering
+    them would change their values instead of removing aliases.
+    """
+    f_tops, widths = [], []
+    for i_fs, i_cycs, i_out in [(f_phase, n_cycles_ph, f_tops),
+                                (f_amp, n_cycles_am, widths)]:
+        for f_range, n_cyc in zip(i_fs, i_cycs):
+            taps = _band_pass_taps(f_range, sfreq, n_cyc)
+            n_fft = next_fast_len(max(8 * len(taps), 4096))
+            response = _band_responses([taps], n_fft)[0]
+            support = np.nonzero(response > tol * response.max())[0]
+            support = support * sfreq / float(n_fft)
+            i_out.append(support.max() if i_out is f_tops else
+                         support.max() - support.min())
+    f_max = max(f_tops) + max(widths)
+    return max(int(sfreq // (2 * f_max)), 1)
+
+
+def _decim_events(events, decim):
+    """Round the samples of events to a grid decimated by ``decim``."""
+    events = np.array(events, copy=True)
+    samples = events if events.ndim == 1 else events[:, 0]
+    samples[:] = np.round(samples / float(decim)).astype(samples.dtype)
+    return events
+
+
+def _check_dtype(dtype):
+    """Check that the dtype of the PAC computations is float32 or 64."""
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("dtype must be 'float32' or 'float64', got %s"
+                         % dtype)
+    return dtype
+
+
+def _band_responses(taps, n_fft):
+    """Zero-phase analytic responses of FIR filters on an rfft grid.
+
+    Returns an array of shape (n_filters, n_fft // 2 + 1) holding the
+    squared magnitude response of each filter, doubled at positive
+    frequencies (but not at DC or Nyquist) so that an inverse FFT over the
+    full grid yields the analytic signal of the filtered data.
+    """
+    analytic = np.ones(n_fft // 2 + 1)
+    analytic[1:(n_fft + 1) // 2] = 2
+    return np.array([np.abs(np.fft.rfft(i_taps, n_fft)) ** 2 * analytic
+                     for i_taps in taps])
+
+
 def phase_locked_amplitude(inst, freqs_phase, freqs_amp, ix_ph, ix_amp,
                            tmin=-.5, tmax=.5, mask_times=None):
     """Calculate the average amplitude of a signal at a phase of another.
@@ -606,18 +1709,14 @@ def _pull_data(inst, ix_ph, ix_amp, events=None, tmin=None, tmax=None):
     return data_ph, data_am
 
 
-def _band_pass_pac(x, f_range, sfreq=1000, n_cycles=3):
+def _band_pass_taps(f_range, sfreq=1000, n_cycles=3, n_times=None):
     """
-    Band-pass filter a signal using PacPy for PAC coupling.
+    Design a band-pass FIR filter for PAC.
 
-    This is a version of the firf function in PacPy, minux edge removal.
-    It's docstring is below
-    ----
-    Filter signal with an FIR filter
-    *Like fir1 in MATLAB
+    This is the filter design of the firf function in PacPy, which is applied
+    with zero phase (i.e., like ``filtfilt``) by `_filter_and_hilbert`. Taps
+    are shared with PacPy through its LRU cache (`pacpy.filt.tap_cache`).
 
-    x : array-like, 1d
-        Time series to filter.
     f_range : (low, high), Hz
         Cutoff frequencies of bandpass filter.
     sfreq : float, Hz
@@ -626,13 +1725,16 @@ def _band_pass_pac(x, f_range, sfreq=1000, n_cycles=3):
         Length of the filter in terms of the number of cycles
         of the oscillation whose frequency is the low cutoff of the
         bandpass filter.
+    n_times : int | None
+        The length of the data to be filtered. If not None, it must be at
+        least as long as the filter.
 
     Returns
     -------
-    x_filt : array-like, 1d
-        Filtered time series.
+    taps : array-like, 1d
+        The filter coefficients.
     """
-    from ..externals.pacpy.filt import firwin, filtfilt
+    from ..externals.pacpy.filt import _firwin_taps
 
     if n_cycles <= 0:
         raise ValueError(
@@ -645,19 +1747,10 @@ def _band_pass_pac(x, f_range, sfreq=1000, n_cycles=3):
     if np.any(np.array(f_range) < 0):
         raise ValueError('Filter frequencies must be positive.')
 
-    n_taps = np.floor(n_cycles * sfreq / f_range[0])
-    if len(x) < n_taps:
+    n_taps = int(np.floor(n_cycles * sfreq / f_range[0]))
+    if n_times is not None and n_times < n_taps:
         raise RuntimeError(
             'Length of filter is longer than data. '
             'Provide more data or a shorter filter.')
 
-    # Perform filtering
-    taps = firwin(n_taps, np.array(f_range) / nyq, pass_zero=False)
-    x_filt = filtfilt(taps, [1], x)
-
-    if any(np.isnan(x_filt)):
-        raise RuntimeError(
-            'Filtered signal contains nans. Adjust filter parameters.')
-
-    # Remove edge artifacts
-    return x_filt
+    return _firwin_taps(n_taps, np.array(f_range) / nyq)
@@ -6,12 +6,14 @@
 
 import numpy as np
 import mne
+from itertools import product
 from nose.tools import assert_true, assert_raises, assert_equal
 from numpy.testing import assert_allclose
-from mne_sandbox.connectivity import (phase_amplitude_coupling,
+from mne_sandbox.connectivity import (phase_amplitude_coupling, comodulogram,
                                       phase_locked_amplitude,
                                       phase_binned_amplitude,
-                                      simulate_pac_signal)
+                                      simulate_pac_signal, PACAccumulator,
+                                      PACFilterCache)
 from sklearn.preprocessing import scale
 
 np.random.seed(1337)
@@ -64,10 +66,6 @@ def test_phase_amplitude_coupling():
     ixs_pac = [0, 1]
     ixs_no_pac = [1, 0]
 
-    assert_raises(ValueError,
-                  phase_amplitude_coupling, epochs, f_band_lo,
-                  f_band_hi, ixs_pac)
-
     # Testing Raw
     conn, _ = phase_amplitude_coupling(
         raw, f_band_lo, f_band_hi, ixs_no_pac, pac_func=pac_func)
@@ -100,6 +98,37 @@ def test_phase_amplitude_coupling():
     # Loosening the min value for frequency because of freq spillage
     assert_true(conn[:, 0, 1, :].mean() < .1)  # Non-pac freqs
 
+    # Parallel output must match serial output, sharding on freqs and chans
+    for n_jobs in (2, 5):
+        conn_par, _ = phase_amplitude_coupling(
+            raw, f_band_lo_mult, f_band_hi_mult, [ixs_pac, ixs_no_pac],
+            pac_func=pac_func, tmin=event_times,
+            tmax=event_times + event_dur, n_cycles_ph=4, n_cycles_am=4,
+            n_jobs=n_jobs)
+        assert_allclose(conn_par[:, :1], conn)
+
+    # Reading and filtering in blocks gives (almost) the same output
+    for i_func in [pac_func, 'glm', 'mi_tort']:
+        conn, _ = phase_amplitude_coupling(
+            raw, f_band_lo_mult, f_band_hi_mult, ixs_pac, pac_func=i_func,
+            tmin=event_times, tmax=event_times + event_dur, n_cycles_ph=4,
+            n_cycles_am=4)
+        conn_blocks, _ = phase_amplitude_coupling(
+            raw, f_band_lo_mult, f_band_hi_mult, ixs_pac, pac_func=i_func,
+            tmin=event_times, tmax=event_times + event_dur, n_cycles_ph=4,
+            n_cycles_am=4, block_duration=3.)
+        assert_allclose(conn_blocks, conn, atol=1e-3)
+    conn_par, _ = phase_amplitude_coupling(
+        raw, f_band_lo_mult, f_band_hi_mult, ixs_pac, pac_func=i_func,
+        tmin=event_times, tmax=event_times + event_dur, n_cycles_ph=4,
+        n_cycles_am=4, block_duration=3., n_jobs=2)
+    assert_allclose(conn_par, conn_blocks)
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, ixs_pac, pac_func='mi_canolty',
+                  block_duration=3.)
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, ixs_pac, events=events, block_duration=3.)
+
     # Testing multiple n_cycles
     assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo_mult,
                   f_band_hi_mult, ixs_pac, pac_func=pac_func,
@@ -138,6 +167,79 @@ def test_phase_amplitude_coupling():
     assert_true(conn.mean() > max_pac)
     assert_equal(conn.shape, (1, 1, 1, 1))
 
+    # One concatenated group per event type, out of bounds events dropped
+    events_types = events.copy()
+    events_types[::2, -1] = 2
+    conn_types, _ = phase_amplitude_coupling(
+        raw, f_band_lo, f_band_hi, ixs_pac, pac_func=pac_func,
+        events=events_types, tmin=0, tmax=event_dur, concat_epochs=True)
+    assert_equal(conn_types.shape, (2, 1, 1, 1))
+    assert_true(conn_types.min() > max_pac)
+    conn_drop, _ = phase_amplitude_coupling(
+        raw, f_band_lo, f_band_hi, ixs_pac, pac_func=pac_func,
+        events=events, tmin=0, tmax=4.)
+    assert_equal(conn_drop.shape, (events.shape[0], 1, 1, 1))
+    assert_true(conn_drop[:-1].min() > 0)
+    assert_true(np.isnan(conn_drop[-1]).all())
+    # Kept events stay in their own rows
+    for kws in [dict(), dict(n_surrogates=5, random_state=0)]:
+        conn_drop = phase_amplitude_coupling(
+            raw, f_band_lo, f_band_hi, ixs_pac, pac_func=pac_func,
+            events=events, tmin=-1.5, tmax=1., **kws)
+        conn_kept = phase_amplitude_coupling(
+            raw, f_band_lo, f_band_hi, ixs_pac, pac_func=pac_func,
+            events=events[1:], tmin=-1.5, tmax=1., **kws)
+        for i_drop, i_kept in zip(conn_drop[::2], conn_kept[::2]):
+            assert_true(np.isnan(i_drop[0]).all())
+            assert_allclose(i_drop[1:], i_kept)
+
+    # Surrogate statistics reuse the filtered data
+    kws_surr = dict(events=events_types, tmin=0, tmax=event_dur,
+                    n_surrogates=20, random_state=0)
+    for method, concat in product(['time_shift', 'epoch_shuffle'],
+                                  [False, True]):
+        # Shuffling needs at least three epochs per event type
+        kws_surr['events'] = events_types if method == 'time_shift' \
+            else events
+        conn, _, conn_z, conn_p = phase_amplitude_coupling(
+            raw, f_band_lo, f_band_hi, [ixs_pac, ixs_no_pac],
+            pac_func=['ozkurt', 'glm'], surrogate_method=method,
+            concat_epochs=concat, **kws_surr)
+        assert_equal(conn_z.shape, conn.shape)
+        assert_equal(conn_p.shape, conn.shape)
+        assert_true(np.all((conn_p > 0) & (conn_p <= 1)))
+        assert_true(np.isfinite(conn_z).all())
+        out_par = phase_amplitude_coupling(
+            raw, f_band_lo, f_band_hi, [ixs_pac, ixs_no_pac],
+            pac_func=['ozkurt', 'glm'], surrogate_method=method,
+            concat_epochs=concat, n_jobs=2, **kws_surr)
+        out_par = [out_par[0]] + list(out_par[2:])
+        for i_out, i_out_par in zip([conn, conn_z, conn_p], out_par):
+            assert_allclose(i_out_par, i_out)
+    # Shuffled surrogates never pair an epoch with itself
+    from mne_sandbox.connectivity.cfc import _draw_surrogates
+    ev_groups = [np.array([0, 2, 4]), np.array([1, 3, 5])]
+    perms = _draw_surrogates(200, 'epoch_shuffle', ['ozkurt'], np.arange(6),
+                             ev_groups, None, random_state=0)
+    assert_true(np.all(perms != np.arange(6)))
+    for i_ev in ev_groups:
+        assert_true(np.all(np.in1d(perms[:, i_ev], i_ev)))
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, ixs_pac, surrogate_method='foo', **kws_surr)
+    kws_surr['events'] = events_types
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, ixs_pac, surrogate_method='epoch_shuffle',
+                  **kws_surr)
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, ixs_pac, pac_func='mi_canolty', **kws_surr)
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, ixs_pac, n_surrogates=0)
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, ixs_pac, n_surrogates=10,
+                  surrogate_method='epoch_shuffle')
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, ixs_pac, n_surrogates=10, block_duration=3.)
+
     # Testing Raw + Epochs + multiple times
     # First time window should have PAC, second window doesn't
     # Testing hi end at .3 because ozkurt seems to peak here
@@ -183,6 +285,666 @@ def test_phase_amplitude_coupling():
     assert_raises(
         ValueError, phase_amplitude_coupling, raw, f_band_lo, f_band_hi,
         [0, 1], pac_func='blah')
+    # otc is a time-frequency method of pacpy, not a batched PAC metric
+    assert_raises(
+        ValueError, phase_amplitude_coupling, raw, f_band_lo, f_band_hi,
+        [0, 1], pac_func='otc')
+
+
+def test_pac_epochs():
+    """Test computing PAC on Epochs."""
+    from mne_sandbox.connectivity.cfc import _phase_amplitude_coupling
+    f_band_lo = [f_phase - 1, f_phase + 1]
+    f_band_hi = [f_amp - 1, f_amp + 1]
+    events_types = events.copy()
+    events_types[::2, -1] = 2
+    epochs_pac = mne.Epochs(raw, events_types, tmin=-.5, tmax=event_dur,
+                            baseline=None, preload=True)
+    data = epochs_pac.get_data()
+    ixs = [[0, 1], [1, 0]]
+    kws_pac = dict(n_cycles_ph=4, n_cycles_am=4)
+
+    # Each epoch is filtered on its own, as if it were passed alone
+    for i_func in ['ozkurt', ['glm', 'mi_tort'], 'plv']:
+        conn, _ = phase_amplitude_coupling(
+            epochs_pac, f_band_lo, f_band_hi, ixs, pac_func=i_func,
+            tmin=[0, -.5], tmax=[event_dur, 0], **kws_pac)
+        assert_equal(conn.shape[-4:], (len(events), 2, 1, 2))
+        conn_ep = np.array([_phase_amplitude_coupling(
+            i_data, sfreq, f_band_lo, f_band_hi, ixs, pac_func=i_func,
+            tmin=[.5, 0], tmax=[event_dur + .5, .5], **kws_pac)[0]
+            for i_data in data])
+        assert_allclose(conn, np.moveaxis(conn_ep, 0, -5)[..., 0, :, :, :],
+                        atol=1e-12)
+    conn, _ = phase_amplitude_coupling(epochs_pac, f_band_lo, f_band_hi, ixs,
+                                       tmin=0, tmax=event_dur, **kws_pac)
+    assert_true(conn[:, 0].min() > max_pac)
+    assert_true(conn[:, 1].max() < min_pac)
+
+    # Epochs are grouped by event type, and laid end to end in time
+    conn, _, data_ph, data_am = phase_amplitude_coupling(
+        epochs_pac, f_band_lo, f_band_hi, ixs, concat_epochs=True,
+        return_data=True)
+    assert_equal(conn.shape, (2, 2, 1, 1))
+    assert_equal(data_ph.shape, (2, 1, data.shape[0] * data.shape[-1]))
+    conn, _, conn_z, conn_p = phase_amplitude_coupling(
+        epochs_pac['2'], f_band_lo, f_band_hi, ixs, n_surrogates=10,
+        surrogate_method='epoch_shuffle', random_state=0)
+    assert_equal(conn_p.shape, conn.shape)
+    assert_raises(ValueError, phase_amplitude_coupling, epochs_pac,
+                  f_band_lo, f_band_hi, ixs, events=events)
+    assert_raises(ValueError, phase_amplitude_coupling, epochs_pac,
+                  f_band_lo, f_band_hi, ixs, block_duration=1.)
+
+
+def test_pac_sliding_window():
+    """Test PAC in sliding windows."""
+    from mne_sandbox.externals.pacpy import pac as ppac
+    f_band_lo = [f_phase - 1, f_phase + 1]
+    f_band_hi = [f_amp - 1, f_amp + 1]
+    ixs = [[0, 1], [1, 0]]
+    kws_pac = dict(n_cycles_ph=4, n_cycles_am=4)
+
+    # Same as the list of windows, computed one by one
+    for i_func in [['ozkurt', 'glm', 'mi_tort'], 'plv']:
+        conn, _ = phase_amplitude_coupling(
+            raw, f_band_lo, f_band_hi, ixs, pac_func=i_func, tmin=1.,
+            tmax=15., sliding_window=(2., .5), **kws_pac)
+        assert_equal(conn.shape[-4:], (1, 2, 1, 25))
+        starts = 1. + .5 * np.arange(25)
+        conn_win, _ = phase_amplitude_coupling(
+            raw, f_band_lo, f_band_hi, ixs, pac_func=i_func, tmin=starts,
+            tmax=starts + 2. - 1. / sfreq, **kws_pac)
+        assert_allclose(conn, conn_win, atol=1e-10)
+    conn, _ = phase_amplitude_coupling(
+        raw, f_band_lo, f_band_hi, ixs, events=events, tmin=0., tmax=2.,
+        sliding_window=(1., .25))
+    assert_equal(conn.shape, (len(events), 2, 1, 5))
+    assert_true(conn[:, 0].min() > max_pac)
+
+    # Windows that aren't a multiple of the step
+    rng = np.random.RandomState(0)
+    lo = rng.uniform(-np.pi, np.pi, (2, 1000))
+    hi = rng.rand(2, 1000) + .5 * np.cos(lo)
+    pac_sliding = ppac._pac_sliding(lo, hi, 'ozkurt', 300, 200)
+    assert_allclose(pac_sliding, np.array(
+        [ppac._ozkurt_batch(lo[:, ii:ii + 300], hi[:, ii:ii + 300])
+         for ii in range(0, 701, 200)]).T)
+    # Coprime window and step, computed in chunks of windows
+    for func in ['ozkurt', 'glm', 'mi_tort']:
+        pac_sliding = ppac._pac_sliding(lo, hi, func, 101, 7, n_chunk=250)
+        assert_allclose(pac_sliding, ppac._pac_sliding(lo, hi, func, 101, 7,
+                                                       n_chunk=1000))
+        assert_allclose(pac_sliding, np.array(
+            [getattr(ppac, '_%s_batch' % func)(lo[:, ii:ii + 101],
+                                               hi[:, ii:ii + 101])
+             for ii in range(0, 900, 7)]).T)
+
+    kws_sliding = dict(tmin=0., tmax=2., sliding_window=(1., .5))
+    for kws in [dict(pac_func='mi_canolty'), dict(n_surrogates=10),
+                dict(events=events, concat_epochs=True),
+                dict(block_duration=3.)]:
+        assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                      f_band_hi, ixs, **dict(kws_sliding, **kws))
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, ixs, tmin=[0., 1.], tmax=[1., 2.],
+                  sliding_window=(1., .5))
+    for sliding_window in [(3., .5), (1., 0), (1.,)]:
+        assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                      f_band_hi, ixs, tmin=0., tmax=2.,
+                      sliding_window=sliding_window)
+
+
+def test_gather_epochs():
+    """Test gathering epochs from filtered signals."""
+    from mne_sandbox.connectivity.cfc import (_gather_epochs,
+                                              _window_sample_ixs)
+    data = np.random.RandomState(0).randn(3, 2, 1000)[:, 1]
+    ev_samps = np.array([100, 420, 50, 700])
+    ch_ixs = np.array([2, 0, 2])
+    samp_ixs = _window_sample_ixs(ev_samps, [[-50, 100], [0, 10]])
+    assert_equal(len(samp_ixs), 2)
+    epochs = _gather_epochs(data, ch_ixs, samp_ixs[0], 150)
+    assert_equal(epochs.shape, (4, 3, 150))
+    for i_ep, i_samp in zip(epochs, ev_samps):
+        assert_allclose(i_ep, data[ch_ixs, i_samp - 50:i_samp + 100])
+    epochs_concat = _gather_epochs(data, ch_ixs, samp_ixs[0][[1, 3]], 150,
+                                   concat=True)
+    assert_allclose(epochs_concat, np.hstack(epochs[[1, 3]]))
+    samp_ixs = _window_sample_ixs(None, [[10, 20]])
+    assert_allclose(_gather_epochs(data, ch_ixs, samp_ixs[0], 10)[0],
+                    data[ch_ixs, 10:20])
+
+
+def test_pac_callback():
+    """Test the statistics given to the PAC callback."""
+    f_band_lo = [f_phase - 1, f_phase + 1]
+    f_band_hi = [f_amp - 1, f_amp + 1]
+    stats = []
+    kws_pac = dict(events=events, tmin=0, tmax=event_dur, n_surrogates=10,
+                   random_state=0)
+    out = phase_amplitude_coupling(raw, f_band_lo, f_band_hi, [0, 1],
+                                   **kws_pac)
+    out_stats = phase_amplitude_coupling(raw, f_band_lo, f_band_hi, [0, 1],
+                                         callback=stats.append, **kws_pac)
+    for i_out, i_out_stats in zip(out, out_stats):
+        assert_allclose(i_out_stats, i_out)
+    assert_equal(len(stats), 1)
+    times = stats[0]['times']
+    assert_equal(set(times), set(['filter', 'epoch', 'metric', 'surrogates',
+                                  'total']))
+    assert_true(all(i_time >= 0 for i_time in times.values()))
+    assert_true(times['total'] >= times['filter'])
+    assert_equal(stats[0]['n_samples'], raw.n_times * 2)
+    assert_true(stats[0]['samples_per_second'] > 0)
+    assert_true(stats[0]['memory'] > raw._data.nbytes)
+
+    comodulogram(epochs, [f_band_lo], [f_band_hi], callback=stats.append)
+    assert_equal(len(stats), 2)
+    assert_true('surrogates' not in stats[1]['times'])
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, [0, 1], callback='foo')
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, [0, 1], callback=stats.append,
+                  block_duration=3.)
+
+
+def test_pac_multirate():
+    """Test computing phase at a lower sampling rate."""
+    from mne_sandbox.connectivity.cfc import (_filter_and_hilbert,
+                                              _band_decim, _band_responses,
+                                              _band_pass_taps)
+    rng = np.random.RandomState(0)
+    data = np.cumsum(rng.randn(2, 20000), axis=-1)
+    f_bands = np.array([[4., 6.], [100., 140.]])
+    full = _filter_and_hilbert(data, sfreq, f_bands, np.array([3, 3]))
+    phase = _filter_and_hilbert(data, sfreq, f_bands, np.array([3, 3]),
+                                transform=np.angle, multirate=True)
+    assert_equal(phase.shape, full.shape)
+    amp = np.abs(full[:, 0])
+    msk = amp > .25 * np.median(amp)
+    error = np.angle(np.exp(1j * (phase[:, 0] - np.angle(full[:, 0]))))
+    assert_true(np.abs(error[msk]).max() < .05)
+    # Bands too fast to decimate are computed as before
+    assert_allclose(phase[:, 1], np.angle(full[:, 1]), atol=1e-12)
+    taps = _band_pass_taps(f_bands[0], sfreq, 3)
+    decim = _band_decim(_band_responses([taps], 24000)[0], 24000, sfreq, 6.)
+    assert_true(decim > 1)
+    assert_equal(24000 % decim, 0)
+    assert_raises(ValueError, _filter_and_hilbert, data, sfreq, f_bands,
+                  np.array([3, 3]), transform=np.abs, multirate=True)
+
+    kws_pac = dict(tmin=event_times, tmax=event_times + event_dur)
+    for i_func in [['ozkurt', 'glm', 'mi_tort'], 'plv']:
+        conn, _ = phase_amplitude_coupling(
+            raw, [f_phase - 1, f_phase + 1], [f_amp - 1, f_amp + 1], [0, 1],
+            pac_func=i_func, **kws_pac)
+        conn_mr, _ = phase_amplitude_coupling(
+            raw, [f_phase - 1, f_phase + 1], [f_amp - 1, f_amp + 1], [0, 1],
+            pac_func=i_func, multirate=True, **kws_pac)
+        assert_allclose(conn_mr, conn, atol=1e-4)
+
+
+def test_pac_decim():
+    """Test computing PAC on decimated phase and amplitude."""
+    from mne_sandbox.connectivity.cfc import _filter_and_hilbert, _auto_decim
+    f_bands = np.array([[f_phase - 1, f_phase + 1], [f_amp - 1, f_amp + 1]])
+    full = _filter_and_hilbert(raw._data, sfreq, f_bands, np.array([3, 3]),
+                               transform=np.angle)
+    decim = _filter_and_hilbert(raw._data, sfreq, f_bands, np.array([3, 3]),
+                                transform=np.angle, decim=3)
+    assert_equal(decim.shape, (2, 2, (raw.n_times - 1) // 3 + 1))
+    assert_allclose(decim, full[..., ::3])
+    assert_true(_auto_decim(sfreq, f_bands[:1], f_bands[1:], [3], [3]) > 1)
+    assert_equal(_auto_decim(100., [[4., 6.]], [[40., 48.]], [3], [3]), 1)
+    # Twice the sum of the top phase frequency and amplitude bandwidth
+    assert_equal(_auto_decim(1000., [[8., 10.]], [[60., 72.]], [3], [3]), 4)
+
+    kws_pac = dict(tmin=event_times, tmax=event_times + event_dur)
+    for i_func in [['ozkurt', 'glm', 'mi_tort'], 'plv']:
+        conn, _ = phase_amplitude_coupling(
+            raw, [f_phase - 1, f_phase + 1], [f_amp - 1, f_amp + 1], [0, 1],
+            pac_func=i_func, **kws_pac)
+        for i_decim in ['auto', 4]:
+            conn_dec, _ = phase_amplitude_coupling(
+                raw, [f_phase - 1, f_phase + 1], [f_amp - 1, f_amp + 1],
+                [0, 1], pac_func=i_func, decim=i_decim, **kws_pac)
+            assert_allclose(conn_dec, conn, atol=5e-3)
+    conn, _ = phase_amplitude_coupling(
+        raw, [f_phase - 1, f_phase + 1], [f_amp - 1, f_amp + 1], [0, 1],
+        events=events, tmin=-.5, tmax=1.5)
+    conn_dec, _, ph, am = phase_amplitude_coupling(
+        raw, [f_phase - 1, f_phase + 1], [f_amp - 1, f_amp + 1], [0, 1],
+        events=events, tmin=-.5, tmax=1.5, decim=4, return_data=True)
+    assert_allclose(conn_dec, conn, atol=5e-3)
+    assert_equal(ph.shape[-1], raw.n_times // 4)
+    conn, _ = phase_amplitude_coupling(
+        epochs, [f_phase - 1, f_phase + 1], [f_amp - 1, f_amp + 1], [0, 1])
+    conn_dec, _ = phase_amplitude_coupling(
+        epochs, [f_phase - 1, f_phase + 1], [f_amp - 1, f_amp + 1], [0, 1],
+        decim='auto')
+    assert_allclose(conn_dec, conn, atol=5e-3)
+
+    for i_decim in [0, 1.5, 'foo']:
+        assert_raises(ValueError, phase_amplitude_coupling, raw,
+                      [f_phase - 1, f_phase + 1], [f_amp - 1, f_amp + 1],
+                      [0, 1], decim=i_decim)
+    assert_raises(ValueError, phase_amplitude_coupling, raw,
+                  [f_phase - 1, f_phase + 1], [f_amp - 1, f_amp + 1],
+                  [0, 1], decim=2, block_duration=5.)
+
+
+def test_pac_batch_funcs():
+    """Test batched pacpy PAC functions against their 1-D versions."""
+    from mne_sandbox.externals.pacpy import pac as ppac
+    rng = np.random.RandomState(0)
+    ph = np.angle(rng.randn(3, 2, 500) + 1j * rng.randn(3, 2, 500))
+    am = np.abs(rng.randn(3, 2, 500)) + 1.
+    for func in ['plv', 'glm', 'mi_tort', 'mi_canolty', 'ozkurt']:
+        batch = getattr(ppac, '_%s_batch' % func)(ph, am)
+        assert_equal(batch.shape, (3, 2))
+        func = getattr(ppac, func)
+        for ii, jj in np.ndindex(3, 2):
+            assert_allclose(batch[ii, jj], func(ph[ii, jj], am[ii, jj],
+                                                None, None, filterfn=False))
+    assert_raises(ValueError, ppac._ozkurt_batch, ph, am[..., 1:])
+
+
+def test_pac_float32():
+    """Test computing PAC in single precision."""
+    from mne_sandbox.connectivity.cfc import _filter_and_hilbert
+    f_band_lo = [[3, 5], [10, 12]]
+    f_band_hi = [[39, 41], [60, 70]]
+    data = np.array([signal_a, signal_b])
+    for dtype in (np.float32, 'float32'):
+        out = _filter_and_hilbert(data, sfreq, np.array(f_band_lo),
+                                  np.array([3, 3]), dtype=dtype)
+        assert_equal(out.dtype, np.complex64)
+    out_64 = _filter_and_hilbert(data, sfreq, np.array(f_band_lo),
+                                 np.array([3, 3]))
+    assert_allclose(out, out_64, atol=1e-5 * np.abs(out_64).max())
+
+    kws_pac = dict(tmin=event_times, tmax=event_times + event_dur,
+                   n_cycles_ph=4, n_cycles_am=4)
+    for i_func, i_f_lo, i_f_hi in [(['ozkurt', 'glm', 'mi_tort'], f_band_lo,
+                                    f_band_hi),
+                                   ('plv', f_band_lo[0], f_band_hi[0])]:
+        conn, _ = phase_amplitude_coupling(raw, i_f_lo, i_f_hi, [0, 1],
+                                           pac_func=i_func, **kws_pac)
+        conn_32, _ = phase_amplitude_coupling(raw, i_f_lo, i_f_hi, [0, 1],
+                                              pac_func=i_func,
+                                              dtype='float32', **kws_pac)
+        assert_allclose(conn_32, conn, rtol=1e-3, atol=1e-5)
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, [0, 1], dtype=np.int32)
+
+
+def test_pac_cache_dir():
+    """Test storing the filtered signals in memory-mapped files."""
+    import os
+    from mne.utils import _TempDir
+    tempdir = _TempDir()
+    f_band_lo = [[3, 5], [10, 12]]
+    f_band_hi = [[39, 41], [60, 70]]
+    kws_pac = dict(tmin=event_times, tmax=event_times + event_dur,
+                   n_cycles_ph=4, n_cycles_am=4)
+    conn, _ = phase_amplitude_coupling(raw, f_band_lo, f_band_hi, [0, 1],
+                                       **kws_pac)
+    conn_cache, _ = phase_amplitude_coupling(
+        raw, f_band_lo, f_band_hi, [0, 1], cache_dir=tempdir, n_jobs=2,
+        **kws_pac)
+    assert_allclose(conn_cache, conn, rtol=1e-4)
+    assert_equal(os.listdir(tempdir), [])
+
+    # The returned signals are memmaps
+    out = phase_amplitude_coupling(raw, f_band_lo, f_band_hi, [0, 1],
+                                   cache_dir=tempdir, return_data=True,
+                                   **kws_pac)
+    assert_allclose(out[0], conn, rtol=1e-4)
+    for i_data in out[2:]:
+        assert_true(isinstance(i_data, np.memmap))
+        assert_equal(i_data.dtype, np.float32)
+    assert_equal(len(os.listdir(tempdir)), 2)
+
+    # Epochs are filtered one at a time into the memmaps
+    for i_func in ['ozkurt', 'plv']:
+        conn, _, ph, am = phase_amplitude_coupling(
+            epochs, [3, 5], [39, 41], [0, 1], pac_func=i_func,
+            return_data=True)
+        conn_cache, _, ph_cache, am_cache = phase_amplitude_coupling(
+            epochs, [3, 5], [39, 41], [0, 1], pac_func=i_func,
+            cache_dir=tempdir, return_data=True)
+        assert_allclose(conn_cache, conn, rtol=1e-4)
+        assert_allclose(ph_cache, ph, atol=1e-4)
+        assert_allclose(am_cache, am, rtol=1e-4, atol=1e-6)
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, [0, 1], cache_dir=os.path.join(tempdir, 'foo'))
+
+
+def test_pac_filter_cache():
+    """Test reusing filtered signals across calls."""
+    from mne.utils import _TempDir
+    tempdir = _TempDir()
+    f_band_lo = [[3, 5], [10, 12]]
+    f_band_hi = [[39, 41], [60, 70]]
+    kws_pac = dict(tmin=event_times, tmax=event_times + event_dur,
+                   n_cycles_ph=4, n_cycles_am=4)
+    conn, _ = phase_amplitude_coupling(raw, f_band_lo, f_band_hi, [0, 1],
+                                       **kws_pac)
+    cache = PACFilterCache(tempdir)
+    for ii in range(2):
+        conn_cache, _ = phase_amplitude_coupling(
+            raw, f_band_lo, f_band_hi, [0, 1], filter_cache=cache, **kws_pac)
+        assert_allclose(conn_cache, conn)
+    assert_equal((cache.hits, cache.misses), (2, 2))
+    assert_equal(cache.info()['n_entries'], 2)
+
+    # Other filters or PAC functions, and caches given by their directory
+    conn_cache, _ = phase_amplitude_coupling(
+        raw, f_band_lo, f_band_hi, [1, 0], pac_func='glm',
+        filter_cache=tempdir, **kws_pac)
+    assert_equal(cache.info()['n_entries'], 4)
+    phase_amplitude_coupling(raw, f_band_lo, f_band_hi, [0, 1],
+                             filter_cache=cache)
+    assert_equal((cache.hits, cache.misses), (2, 4))
+    assert_raises(ValueError, phase_amplitude_coupling, raw, f_band_lo,
+                  f_band_hi, [0, 1], filter_cache=1)
+
+    # Least recently used entries are evicted
+    size = cache.info()['size']
+    cache.max_size = size / 2.
+    cache.put(cache.key('foo'), np.zeros(10))
+    assert_true(cache.info()['size'] <= 0.9 * size / 2.)
+    assert_true(cache.get(cache.key('foo')) is not None)
+    # The size is tracked without listing the directory on each put
+    cache.max_size = size
+    for ii in range(3):
+        cache.put(cache.key('foo'), np.zeros(10 + ii))
+        cache.put(cache.key('bar', ii), np.zeros(10))
+        assert_equal(cache._size, cache.info()['size'])
+    cache.clear()
+    assert_equal(cache.info()['n_entries'], 0)
+    assert_raises(ValueError, PACFilterCache, tempdir, 0)
+
+
+def test_multichannel_comodulogram():
+    """Test comodulograms of all channel pairs."""
+    f_band_lo = [[3, 5], [10, 12]]
+    f_band_hi = [[39, 41], [60, 70]]
+    comod, ixs = comodulogram(raw, f_band_lo, f_band_hi, n_cycles_ph=4,
+                              n_cycles_am=4)
+    assert_equal(comod.shape, (4, 2, 2))
+    assert_equal(ixs.tolist(), [[0, 0], [0, 1], [1, 0], [1, 1]])
+    conn, _ = phase_amplitude_coupling(raw, f_band_lo, f_band_hi, [0, 1],
+                                       n_cycles_ph=4, n_cycles_am=4)
+    assert_allclose(comod[1].ravel(), conn.ravel())
+    # PAC only between phase of channel 0 and amplitude of channel 1
+    assert_true(comod[1, 0, 0] > 5 * comod[2, 0, 0])
+    assert_true(comod[1, 0, 0] > 5 * comod[1, 1, 1])
+
+    # Epochs are averaged, multiple PAC functions get their own dimension
+    comod, ixs = comodulogram(epochs, f_band_lo, f_band_hi, ixs=[[0, 1]],
+                              pac_func=['ozkurt', 'glm'], tmin=2, tmax=4,
+                              n_cycles_ph=4, n_cycles_am=4, n_jobs=2)
+    assert_equal(comod.shape, (2, 1, 2, 2))
+    conn = []
+    for i_ep in epochs.get_data():
+        raw_ep = mne.io.RawArray(i_ep, epochs.info, verbose=False)
+        conn.append(phase_amplitude_coupling(
+            raw_ep, f_band_lo, f_band_hi, [0, 1], pac_func=['ozkurt', 'glm'],
+            tmin=1, tmax=3, n_cycles_ph=4, n_cycles_am=4)[0])
+    assert_allclose(comod.ravel(), np.mean(conn, axis=0).ravel())
+    # Only the channels of ixs are read
+    comod_1, _ = comodulogram(epochs, f_band_lo, f_band_hi, ixs=[[1, 1]],
+                              pac_func='ozkurt', tmin=2, tmax=4,
+                              n_cycles_ph=4, n_cycles_am=4)
+    comod_all, _ = comodulogram(epochs, f_band_lo, f_band_hi,
+                                pac_func='ozkurt', tmin=2, tmax=4,
+                                n_cycles_ph=4, n_cycles_am=4)
+    assert_allclose(comod_1[0], comod_all[3])
+    assert_raises(ValueError, comodulogram, raw, f_band_lo, f_band_hi,
+                  ixs=[0, 1, 1])
+    assert_raises(ValueError, comodulogram, raw.get_data(), f_band_lo,
+                  f_band_hi)
+
+
+def test_comodulogram():
+    """Test the comodulogram engine against PAC of each cell."""
+    from mne_sandbox.externals.pacpy import pac as ppac
+    lo, hi = signal_a[:8000], signal_b[:8000]
+    for func in ['plv', 'glm', 'mi_tort', 'mi_canolty', 'ozkurt']:
+        comod = ppac.comodulogram(lo, hi, (4, 12), (20, 60), 4, 20,
+                                  fs=sfreq, pac_method=func)
+        assert_equal(comod.shape, (2, 2))
+        for p, f_lo in enumerate([(4, 8), (8, 12)]):
+            for a, f_hi in enumerate([(20, 40), (40, 60)]):
+                pac = getattr(ppac, func)(lo, hi, f_lo, f_hi, fs=sfreq)
+                assert_allclose(comod[p, a], pac, rtol=1e-10)
+    assert_raises(ValueError, ppac.comodulogram, lo, hi, (2, 8), (20, 60),
+                  3, 20, pac_method='foo')
+
+
+def test_pac_surrogates():
+    """Test PAC of circularly shifted surrogates."""
+    from mne_sandbox.externals.pacpy import pac as ppac
+    rng = np.random.RandomState(0)
+    ph = np.angle(rng.randn(2, 300) + 1j * rng.randn(2, 300))
+    am = np.abs(rng.randn(2, 300)) + np.cos(ph)
+    shifts = np.random.RandomState(42).randint(300, size=5)
+    for func in ['plv', 'glm', 'mi_tort', 'ozkurt']:
+        pac_surr = ppac._pac_surrogates(ph, am, func, n_surr=5,
+                                        random_state=42)
+        assert_equal(pac_surr.shape, (2, 5))
+        batch_func = getattr(ppac, '_%s_batch' % func)
+        for i_surr, shift in enumerate(shifts):
+            assert_allclose(pac_surr[:, i_surr],
+                            batch_func(np.roll(ph, shift, axis=-1), am))
+    assert_raises(ValueError, ppac._pac_surrogates, ph, am, 'otc')
+
+    # Surrogates leave the global random state alone
+    state = np.random.get_state()[1].copy()
+    ppac._mi_canolty_batch(ph, am, random_state=0)
+    assert_allclose(np.random.get_state()[1], state)
+    if hasattr(np.random, 'default_rng'):
+        pac = ppac._mi_canolty_batch(ph, am,
+                                     random_state=np.random.default_rng(0))
+        assert_equal(pac.shape, (2,))
+    assert_raises(ValueError, ppac._mi_canolty_batch, ph, am,
+                  random_state='foo')
+
+
+def test_phase_bin_sums():
+    """Test binning amplitudes by phase over many time series."""
+    from mne_sandbox.externals.pacpy import pac as ppac
+    rng = np.random.RandomState(0)
+    ph = np.angle(rng.randn(2, 3, 500) + 1j * rng.randn(2, 3, 500))
+    ph[0, 0, :10] = np.pi  # Out of the bins
+    am = np.abs(rng.randn(2, 3, 500))
+    bins, dist = ppac.pa_dist(ph, am, Nbins=18)
+    assert_equal(dist.shape, (2, 3, 18))
+    assert_allclose(bins, np.linspace(-np.pi, np.pi, 19)[:-1])
+    for ix in np.ndindex(ph.shape[:-1]):
+        ixs_bin = np.digitize(ph[ix], bins) - 1
+        ixs_bin[ph[ix] >= np.pi] = -1
+        assert_allclose(dist[ix], [am[ix][ixs_bin == i].mean()
+                                   for i in range(18)])
+    assert_raises(ValueError, ppac.pa_dist, ph, am[..., 1:])
+
+    # mi_tort bins the phases in degrees, which moves samples on the edges
+    ph = np.linspace(-np.pi, np.pi, 1201)[:-1]
+    am = np.abs(rng.randn(len(ph)))
+    edges = np.arange(-180, 180, 360 / 20.)
+    mean_amp = [am[(np.degrees(ph) >= e) & (np.degrees(ph) < e + 18)].mean()
+                for e in edges]
+    assert_allclose(ppac._mi_tort_batch(ph, am),
+                    ppac._mi_tort_from_mean_amp(np.array(mean_amp), 20))
+
+
+def test_pac_accumulator():
+    """Test accumulating PAC over chunks of data."""
+    from mne_sandbox.externals.pacpy import pac as ppac
+    rng = np.random.RandomState(0)
+    ph = np.angle(rng.randn(3, 900) + 1j * rng.randn(3, 900))
+    am = np.abs(rng.randn(3, 900)) + 1. + np.cos(ph)
+    for func in ['plv', 'glm', 'mi_tort', 'ozkurt']:
+        pac = getattr(ppac, '_%s_batch' % func)(ph, am)
+        acc = PACAccumulator(func)
+        for i_ph, i_am in zip(np.split(ph, 3, -1), np.split(am, 3, -1)):
+            acc.update(i_ph, i_am)
+        assert_equal(acc.n_times, 900)
+        assert_allclose(acc.compute(), pac)
+        # Merging partial accumulators gives the same result
+        acc_a = PACAccumulator(func).update(ph[:, :200], am[:, :200])
+        acc_b = PACAccumulator(func).update(ph[:, 200:], am[:, 200:])
+        assert_allclose(acc_a.merge(acc_b).compute(), pac)
+        assert_raises(ValueError, acc.update, ph[:2], am[:2])
+    assert_raises(ValueError, PACAccumulator, 'mi_canolty')
+    assert_raises(ValueError, PACAccumulator, 'foo')
+    assert_raises(ValueError, PACAccumulator('ozkurt').merge,
+                  PACAccumulator('plv'))
+    assert_raises(RuntimeError, PACAccumulator('ozkurt').compute)
+
+
+def test_filter_and_hilbert():
+    """Test the FFT filter bank against time-domain filtering."""
+    from scipy.signal import filtfilt
+    from mne_sandbox.connectivity.cfc import (_filter_and_hilbert,
+                                              _band_pass_taps)
+    rng = np.random.RandomState(0)
+    data = rng.randn(2, 5000)
+    f_bands = np.array([[4., 6.], [38., 42.]])
+    out = _filter_and_hilbert(data, sfreq, f_bands, np.array([3, 3]))
+    assert_equal(out.shape, (2, 2, 5000))
+    for i_band, i_out in zip(f_bands, out.transpose(1, 0, 2)):
+        taps = _band_pass_taps(i_band, sfreq, 3)
+        n_taps = len(taps)
+        # Away from the edges, the real part is the zero-phase filtered data
+        assert_allclose(i_out.real[:, n_taps:-n_taps],
+                        filtfilt(taps, [1], data)[:, n_taps:-n_taps],
+                        atol=1e-10)
+    assert_raises(RuntimeError, _filter_and_hilbert, data[:, :100], sfreq,
+                  f_bands, np.array([3, 3]))
+
+
+def test_fasthilbert():
+    """Test the real-FFT Hilbert transform."""
+    from scipy.signal import hilbert
+    from mne_sandbox.externals.pacpy.util import fasthilbert
+    from mne_sandbox.externals.pacpy import pac as ppac
+    rng = np.random.RandomState(0)
+    for n_times in (1000, 1009):  # Even and odd lengths
+        data = rng.randn(2, n_times)
+        assert_allclose(fasthilbert(data), hilbert(data), atol=1e-12)
+        assert_allclose(fasthilbert(data.T, axis=0),
+                        hilbert(data.T, axis=0), atol=1e-12)
+        assert_allclose(ppac.hilbert(data[0]), hilbert(data[0]),
+                        atol=1e-12)
+    assert_equal(fasthilbert(data.astype(np.float32)).dtype, np.complex64)
+
+
+def test_filtfilt_fft():
+    """Test zero-phase FIR filtering by overlap-add FFT convolution."""
+    from scipy.signal import filtfilt
+    from mne_sandbox.externals.pacpy.filt import (filtfilt_fft, firf, firfls,
+                                                  _firwin_taps)
+    rng = np.random.RandomState(0)
+    data = rng.randn(2, 3, 5000)
+    taps = _firwin_taps(750, [4. / 500, 6. / 500])
+    n_taps = len(taps)
+    expected = filtfilt(taps, [1], data)[..., n_taps:-n_taps]
+    # Single block, several blocks, and along another axis
+    for n_fft in [None, 4096]:
+        assert_allclose(filtfilt_fft(taps, data, n_fft=n_fft)[
+            ..., n_taps:-n_taps], expected, atol=1e-12)
+    assert_allclose(filtfilt_fft(taps, data.T, axis=0)[n_taps:-n_taps],
+                    expected.T, atol=1e-12)
+    assert_raises(ValueError, filtfilt_fft, taps, data, n_fft=1000)
+
+    # Channels are filtered at once, like each on its own
+    for func in [firf, firfls]:
+        out = func(data, [4., 6.], sfreq, 3)
+        assert_equal(out.shape, (2, 3, 5000 - 2 * 750))
+        assert_allclose(out[1, 2], func(data[1, 2], [4., 6.], sfreq, 3))
+        assert_allclose(func(data.T, [4., 6.], sfreq, 3, axis=0), out.T)
+
+
+def test_morlet_transform():
+    """Test the batched Morlet wavelet transform."""
+    from mne_sandbox.externals.pacpy.filt import (morlet_transform, morletf,
+                                                  _morlet_wavelet)
+    from mne_sandbox.externals.pacpy.pac import _morletT
+    rng = np.random.RandomState(0)
+    data = rng.randn(3000)
+    f0s = np.arange(10., 100., 15.)
+    out = _morletT(data, f0s, fs=sfreq)
+    assert_equal(out.shape, (len(f0s), len(data)))
+    for f0, i_out in zip(f0s, out):
+        wavelet = _morlet_wavelet(f0, fs=sfreq)
+        assert_allclose(i_out, np.convolve(data, wavelet, mode='same'),
+                        atol=1e-12)
+    assert_allclose(morlet_transform(data, f0s, sfreq, block_size=4), out,
+                    atol=1e-12)
+    assert_allclose(morletf(data, f0s[1], sfreq), out[1], atol=1e-12)
+    # Wavelets longer than the data, as with np.convolve
+    wavelet = _morlet_wavelet(4., fs=sfreq)
+    assert_true(len(wavelet) > 100)
+    assert_allclose(morletf(data[:100], 4., sfreq),
+                    np.convolve(data[:100], wavelet, mode='same'), atol=1e-12)
+    offset = (len(wavelet) - 1) // 2
+    assert_allclose(morlet_transform(data[:100], [4., 40.], sfreq)[0],
+                    np.convolve(data[:100], wavelet)[offset:offset + 100],
+                    atol=1e-12)
+    assert_raises(ValueError, morlet_transform, data, f0s, sfreq,
+                  block_size=0)
+    assert_raises(ValueError, morlet_transform, data, f0s, sfreq, w=0)
+
+
+def test_peaktimes():
+    """Test the vectorized detection of high frequency events."""
+    from mne_sandbox.externals.pacpy.pac import _peaktimes, _chunk_time
+    mask = np.array([0, 1, 1, 0, 0, 1, 0, 0, 0, 0, 1, 1], dtype=bool)
+    assert_allclose(_chunk_time(mask), [[1, 2], [5, 5], [10, 11]])
+    assert_allclose(_chunk_time(mask, samp_buffer=2), [[1, 5], [10, 11]])
+    assert_allclose(_chunk_time(np.flatnonzero(mask)), _chunk_time(mask))
+    assert_equal(_chunk_time(np.zeros(10, dtype=bool)).shape, (0, 2))
+    assert_raises(ValueError, _chunk_time, mask, samp_buffer=-1)
+
+    x = np.array([0., 3, 5, 5, 0, 0, 4, 0, 0, 0, 6, 2, 0])
+    # Ties go to the first maximum, and close events are merged
+    assert_allclose(_peaktimes(x, prc=50, t_buffer=0), [2, 6, 10])
+    assert_allclose(_peaktimes(x, prc=50, t_buffer=.002), [2, 10])
+    assert_allclose(_peaktimes(x, prc=50, t_buffer=.003), [10])
+
+    # All rows at once, each with its own threshold
+    rng = np.random.RandomState(0)
+    data = np.abs(rng.randn(3, 2000))
+    data[1] *= 10
+    events = _peaktimes(data, prc=95, t_buffer=.005)
+    assert_equal(len(events), 3)
+    for i_data, i_events in zip(data, events):
+        assert_allclose(i_events, _peaktimes(i_data, prc=95, t_buffer=.005))
+        assert_true(i_events.max() < i_data.shape[-1])
+    assert_raises(ValueError, _peaktimes, x, prc=100)
+
+
+def test_tap_cache():
+    """Test the LRU cache of FIR filter taps."""
+    from mne_sandbox.externals.pacpy.filt import _TapCache, tap_cache, firf
+    from mne_sandbox.connectivity.cfc import _band_pass_taps
+    tap_cache.clear()
+    taps = _band_pass_taps([4., 6.], sfreq, 3)
+    assert_true(_band_pass_taps([4., 6.], sfreq, 3) is taps)
+    assert_raises(ValueError, taps.__setitem__, 0, 1.)
+    # The same design is shared with pacpy
+    firf(signal_a, [4., 6.], sfreq, 3)
+    assert_equal(tap_cache.info()['misses'], 1)
+    assert_equal(tap_cache.info()['hits'], 2)
+
+    cache = _TapCache(max_size=2)
+    for key in ['a', 'b', 'a', 'c', 'b']:
+        cache.get(key, lambda: np.ones(3))
+    assert_equal(cache.info(), dict(hits=1, misses=4, size=2, max_size=2))
+    tap_cache.clear()
 
 
 def test_phase_amplitude_viz_funcs():
@@ -242,5 +1004,26 @@ def test_phase_amplitude_coupling_simulation():
 
 if __name__ == '__main__':
     test_phase_amplitude_coupling()
+    test_pac_epochs()
+    test_pac_sliding_window()
+    test_gather_epochs()
+    test_pac_callback()
+    test_pac_multirate()
+    test_pac_decim()
+    test_pac_batch_funcs()
+    test_pac_float32()
+    test_pac_cache_dir()
+    test_pac_filter_cache()
+    test_multichannel_comodulogram()
+    test_comodulogram()
+    test_pac_surrogates()
+    test_phase_bin_sums()
+    test_pac_accumulator()
+    test_filter_and_hilbert()
+    test_fasthilbert()
+    test_filtfilt_fft()
+    test_morlet_transform()
+    test_peaktimes()
+    test_tap_cache()
     test_phase_amplitude_viz_funcs()
     test_phase_amplitude_coupling_simulation()
@@ -1,18 +1,133 @@
 from __future__ import division
+from collections import OrderedDict
 import numpy as np
 
-from scipy.signal import filtfilt
 from scipy.signal import firwin2, firwin
 from scipy.signal import morlet
 
+from .util import fft, ifft, irfft, rfft, next_fast_len
 
-def firf(x, f_range, fs=1000, w=3):
+
+class _TapCache(object):
+    """
+    Least-recently-used cache of FIR filter taps, keyed on the filter design
+    parameters. Cached taps are read-only.
+
+    max_size : int
+        The maximum number of filters to keep
+
+    The number of cache hits and misses are kept in `hits` and `misses`
+    for diagnostics, see also `info()`.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.clear()
+
+    def clear(self):
+        """Empty the cache and reset the hit/miss counters"""
+        self._taps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """Return a dict with the cache statistics"""
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self._taps), max_size=self.max_size)
+
+    def get(self, key, design):
+        """Return the taps for `key`, calling `design()` on a cache miss"""
+        try:
+            taps = self._taps.pop(key)
+            self.hits += 1
+        except KeyError:
+            taps = np.asarray(design())
+            taps.flags.writeable = False
+            self.misses += 1
+            if len(self._taps) >= self.max_size:
+                self._taps.popitem(last=False)
+        self._taps[key] = taps
+        return taps
+
+
+# Taps shared by every filter design in pacpy and mne_sandbox
+tap_cache = _TapCache()
+
+
+def _firwin_taps(Ntaps, cutoff):
+    """Cached band-pass `firwin` design, cutoff in normalized frequency"""
+    Ntaps = int(Ntaps)
+    cutoff = tuple(float(c) for c in cutoff)
+    return tap_cache.get(('firwin', Ntaps, cutoff),
+                         lambda: firwin(Ntaps, cutoff, pass_zero=False))
+
+
+def _firwin2_taps(Ntaps, f, m):
+    """Cached `firwin2` design, frequencies in normalized frequency"""
+    Ntaps = int(Ntaps)
+    f = tuple(float(i_f) for i_f in f)
+    m = tuple(float(i_m) for i_m in m)
+    return tap_cache.get(('firwin2', Ntaps, f, m),
+                         lambda: firwin2(Ntaps, f, m))
+
+
+def filtfilt_fft(taps, x, axis=-1, n_fft=None):
+    """
+    Zero-phase FIR filtering by overlap-add FFT convolution
+
+    The forward and time-reversed passes of `scipy.signal.filtfilt` are done
+    in a single pass with the squared magnitude response of the filter, i.e.
+    a convolution with the autocorrelation of `taps`. The output is the same
+    as `filtfilt(taps, [1], x, axis)`, except for the `len(taps)` samples at
+    each edge, where `x` is padded with zeros instead of its odd extension.
+
+    taps : array-like, 1d
+        The FIR filter coefficients
+    x : array
+        Time series to filter, of any number of dimensions
+    axis : int
+        The axis along which to filter
+    n_fft : int | None
+        The FFT length of the blocks. Defaults to a fast length of about
+        8 times the length of the kernel, or the full signal if shorter
+
+    Returns
+    -------
+    x_filt : array
+        Filtered time series, of the same shape as x
+    """
+    taps = np.asarray(taps)
+    kernel = np.convolve(taps, taps[::-1])
+    n_kernel = len(kernel)
+    x = np.moveaxis(np.asarray(x), axis, -1)
+    N = x.shape[-1]
+    if n_fft is None:
+        n_fft = next_fast_len(min(N, 7 * n_kernel) + n_kernel - 1)
+    n_block = n_fft - n_kernel + 1
+    if n_block < 1:
+        raise ValueError('n_fft must be at least the length of the kernel, '
+                         '%d' % n_kernel)
+    kernel_fft = rfft(kernel, n_fft)
+
+    # Full convolution, from which the kernel delay is removed at the end
+    x_filt = np.zeros(x.shape[:-1] + (N + n_kernel - 1,),
+                      dtype=np.result_type(x, kernel_fft.real))
+    for start in range(0, N, n_block):
+        x_block = x[..., start:start + n_block]
+        n_out = x_block.shape[-1] + n_kernel - 1
+        x_filt[..., start:start + n_out] += irfft(
+            rfft(x_block, n_fft) * kernel_fft, n_fft)[..., :n_out]
+    x_filt = x_filt[..., len(taps) - 1:len(taps) - 1 + N]
+    return np.moveaxis(x_filt, -1, axis)
+
+
+def firf(x, f_range, fs=1000, w=3, axis=-1):
     """
     Filter signal with an FIR filter
     *Like fir1 in MATLAB
 
-    x : array-like, 1d
-        Time series to filter
+    x : array-like
+        Time series to filter, of any number of dimensions
     f_range : (low, high), Hz
         Cutoff frequencies of bandpass filter
     fs : float, Hz
@@ -21,11 +136,13 @@ def firf(x, f_range, fs=1000, w=3):
         Length of the filter in terms of the number of cycles 
         of the oscillation whose frequency is the low cutoff of the 
         bandpass filter
+    axis : int
+        The time axis of x
 
     Returns
     -------
-    x_filt : array-like, 1d
-        Filtered time series
+    x_filt : array-like
+        Filtered time series, without the edge artifacts along axis
     """
 
     if w <= 0:
@@ -40,30 +157,30 @@ def firf(x, f_range, fs=1000, w=3):
         raise ValueError('Filter frequencies must be positive.')
 
     Ntaps = np.floor(w * fs / f_range[0])
-    if len(x) < Ntaps:
+    if np.shape(x)[axis] < Ntaps:
         raise RuntimeError(
             'Length of filter is loger than data. '
             'Provide more data or a shorter filter.')
 
     # Perform filtering
-    taps = firwin(Ntaps, np.array(f_range) / nyq, pass_zero=False)
-    x_filt = filtfilt(taps, [1], x)
+    taps = _firwin_taps(Ntaps, np.array(f_range) / nyq)
+    x_filt = filtfilt_fft(taps, x, axis=axis)
 
-    if any(np.isnan(x_filt)):
+    if np.isnan(x_filt).any():
         raise RuntimeError(
             'Filtered signal contains nans. Adjust filter parameters.')
 
     # Remove edge artifacts
-    return _remove_edge(x_filt, Ntaps)
+    return _remove_edge(x_filt, Ntaps, axis=axis)
 
 
-def firfls(x, f_range, fs=1000, w=3, tw=.15):
+def firfls(x, f_range, fs=1000, w=3, tw=.15, axis=-1):
     """
     Filter signal with an FIR filter
     *Like firls in MATLAB
 
-    x : array-like, 1d
-        Time series to filter
+    x : array-like
+        Time series to filter, of any number of dimensions
     f_range : (low, high), Hz
         Cutoff frequencies of bandpass filter
     fs : float, Hz
@@ -74,11 +191,13 @@ def firfls(x, f_range, fs=1000, w=3, tw=.15):
         bandpass filter
     tw : float
         Transition width of the filter in normalized frequency space
+    axis : int
+        The time axis of x
 
     Returns
     -------
-    x_filt : array-like, 1d
-        Filtered time series
+    x_filt : array-like
+        Filtered time series, without the edge artifacts along axis
     """
 
     if w <= 0:
@@ -96,7 +215,7 @@ def firfls(x, f_range, fs=1000, w=3, tw=.15):
         raise ValueError('Filter frequencies must be positive.')
 
     Ntaps = np.floor(w * fs / f_range[0])
-    if len(x) < Ntaps:
+    if np.shape(x)[axis] < Ntaps:
         raise RuntimeError(
             'Length of filter is loger than data. '
             'Provide more data or a shorter filter.')
@@ -111,15 +230,15 @@ def firfls(x, f_range, fs=1000, w=3, tw=.15):
             'Please decrease the transition width parameter.')
 
     # Perform filtering
-    taps = firwin2(Ntaps, f, m)
-    x_filt = filtfilt(taps, [1], x)
+    taps = _firwin2_taps(Ntaps, f, m)
+    x_filt = filtfilt_fft(taps, x, axis=axis)
 
-    if any(np.isnan(x_filt)):
+    if np.isnan(x_filt).any():
         raise RuntimeError(
             'Filtered signal contains nans. Adjust filter parameters.')
 
     # Remove edge artifacts
-    return _remove_edge(x_filt, Ntaps)
+    return _remove_edge(x_filt, Ntaps, axis=axis)
 
 
 def morletf(x, f0, fs=1000, w=3, s=1, M=None, norm='sss'):
@@ -156,15 +275,64 @@ def morletf(x, f0, fs=1000, w=3, s=1, M=None, norm='sss'):
     x_trans : array
         Complex time series
     """
+    morlet_f = _morlet_wavelet(f0, fs=fs, w=w, s=s, M=M, norm=norm)
+    if len(morlet_f) > len(x):
+        # The 'same' output is then as long as the wavelet
+        return np.convolve(x, morlet_f, mode='same')
+    return _wavelet_transform(x, [morlet_f])[0]
+
+
+def morlet_transform(x, f0s, fs=1000, w=3, s=1, norm='sss', block_size=None):
+    """
+    Convolve a signal with the complex wavelets of `morletf` at several
+    frequencies at once
 
+    The signal is Fourier transformed once. Each block of frequencies then
+    takes a single complex product with the spectra of their wavelets and
+    one inverse FFT. The output is the same as calling `morletf` for each
+    frequency, up to rounding errors. Wavelets longer than `x` are allowed,
+    and their output is the `len(x)` samples of the convolution centered on
+    `x` (`morletf` returns the `'same'` convolution, as long as the wavelet).
+
+    x : array, 1d
+        Time series to filter
+    f0s : array, 1d
+        Center frequencies of the wavelets
+    fs : float
+        Sampling rate
+    w : float
+        Length of the filters in terms of the number of
+        cycles of the oscillation with frequency f0
+    s : float
+        Scaling factor for the morlet wavelets
+    norm : string
+        Normalization method, see `morletf`
+    block_size : int | None
+        The number of frequencies transformed at a time, which bounds the
+        memory to about `2 * block_size * (len(x) + M)` complex values,
+        where M is the length of the longest wavelet. Defaults to all
+        frequencies at once
+
+    Returns
+    -------
+    x_trans : array, shape (len(f0s), len(x))
+        Complex time series of each frequency
+    """
+    wavelets = [_morlet_wavelet(f0, fs=fs, w=w, s=s, norm=norm)
+                for f0 in np.atleast_1d(f0s)]
+    return _wavelet_transform(x, wavelets, block_size=block_size)
+
+
+def _morlet_wavelet(f0, fs=1000, w=3, s=1, M=None, norm='sss'):
+    """Normalized complex morlet wavelet of `morletf`"""
     if w <= 0:
         raise ValueError(
             'Number of cycles in a filter must be a positive number.')
 
-    if M == None:
+    if M is None:
         M = 2 * s * w * fs / f0
 
-    morlet_f = morlet(M, w=w, s=s)
+    morlet_f = morlet(int(M), w=w, s=s)
 
     if norm == 'sss':
         morlet_f = morlet_f / np.sqrt(np.sum(np.abs(morlet_f)**2))
@@ -172,18 +340,41 @@ def morletf(x, f0, fs=1000, w=3, s=1, M=None, norm='sss'):
         morlet_f = morlet_f / np.sum(np.abs(morlet_f)) * 2
     else:
         raise ValueError('Not a valid wavelet normalization method.')
+    return morlet_f
 
-    x_filtR = np.convolve(x, np.real(morlet_f), mode='same')
-    x_filtI = np.convolve(x, np.imag(morlet_f), mode='same')
-
-    # Remove edge artifacts
-    #x_filtR = _remove_edge(x_filtR, M/2.)
-    #x_filtI = _remove_edge(x_filtI, M/2.)
 
-    return x_filtR + 1j * x_filtI
-
-
-def _remove_edge(x, N):
+def _wavelet_transform(x, wavelets, block_size=None):
+    """
+    Convolve a 1d signal with complex wavelets by FFT, like
+    `np.convolve(x, wavelet, mode='same')` for each wavelet, in blocks of
+    `block_size` wavelets. The output is always centered on `x`, even for
+    wavelets longer than `x`
+    """
+    x = np.asarray(x)
+    N = len(x)
+    M_max = max(len(wavelet) for wavelet in wavelets)
+    if block_size is None:
+        block_size = len(wavelets)
+    if block_size < 1:
+        raise ValueError('block_size must be a positive integer.')
+
+    n_fft = next_fast_len(N + M_max - 1)
+    x_fft = fft(x, n_fft)
+    x_trans = np.zeros((len(wavelets), N),
+                       dtype=np.result_type(x, np.complex64))
+    for start in range(0, len(wavelets), block_size):
+        block = wavelets[start:start + block_size]
+        wavelets_fft = np.array([fft(wavelet, n_fft) for wavelet in block])
+        wavelets_fft *= x_fft
+        block_trans = ifft(wavelets_fft, n_fft)
+        # Center the output of each wavelet on the input, as with 'same'
+        for ii, (wavelet, i_trans) in enumerate(zip(block, block_trans)):
+            offset = (len(wavelet) - 1) // 2
+            x_trans[start + ii] = i_trans[offset:offset + N]
+    return x_trans
+
+
+def _remove_edge(x, N, axis=-1):
     """
     Calculate the number of points to remove for edge artifacts
 
@@ -191,6 +382,9 @@ def _remove_edge(x, N):
         time series to remove edge artifacts from
     N : int
         length of filter
+    axis : int
+        time axis of x
     """
     N = int(N)
-    return x[N:-N]
+    x = np.moveaxis(x, axis, -1)[..., N:-N]
+    return np.moveaxis(x, -1, axis)
@@ -4,9 +4,9 @@ Functions to calculate phase-amplitude coupling.
 """
 from __future__ import division
 import numpy as np
-from scipy.signal import hilbert
 from scipy.stats.mstats import zscore
-from .filt import firf, morletf
+from .filt import firf, morlet_transform
+from .util import fasthilbert as hilbert
 
 
 def _x_sanity(lo=None, hi=None):
@@ -111,11 +111,26 @@ def plv(lo, hi, f_lo, f_hi, fs=1000, filterfn=None, filter_kwargs=None):
     lo, hi = _trim_edges(lo, hi)
 
     # Calculate PLV
-    pac = np.abs(np.mean(np.exp(1j * (lo - hi))))
+    pac = _plv_batch(lo, hi)
 
     return pac
 
 
+def _plv_batch(lo, hi):
+    """
+    PLV from prefiltered phase time series of any shape, reducing along the
+    last (time) axis. Equivalent to `plv` with `filterfn=False`.
+    """
+    _batch_sanity(lo, hi)
+    return np.abs(np.mean(np.exp(1j * (lo - hi)), axis=-1))
+
+
+def _batch_sanity(lo, hi):
+    """Check that batched phase/amplitude arrays share a time axis"""
+    if lo.shape[-1] != hi.shape[-1]:
+        raise ValueError("lo and hi must be the same length")
+
+
 def _trim_edges(lo, hi):
     """
     Remove extra edge artifact from the signal with the shorter filter
@@ -189,7 +204,7 @@ def mi_tort(lo, hi, f_lo, f_hi, fs=1000, Nbins=20, filterfn=None,
     >>> hi = np.sin(t * 2 * np.pi * 100) # Create modulated oscillation
     >>> hi[np.angle(hilbert(lo)) > -np.pi*.5] = 0 # Clip to 1/4 of cycle
     >>> mi_tort(lo, hi, (4,8), (80,150)) # Calculate PAC
-    0.34898478944110811
+    0.34895713570513054
     """
 
     # Arg check
@@ -218,39 +233,74 @@ def mi_tort(lo, hi, f_lo, f_hi, fs=1000, Nbins=20, filterfn=None,
     # Make arrays the same size
     lo, hi = _trim_edges(lo, hi)
 
-    # Convert the phase time series from radians to degrees
-    phadeg = np.degrees(lo)
-
     # Calculate PAC
-    binsize = 360 / Nbins
-    phase_lo = np.arange(-180, 180, binsize)
-    mean_amp = np.zeros(len(phase_lo))
-    for b in range(len(phase_lo)):
-        phaserange = np.logical_and(phadeg >= phase_lo[b],
-                                    phadeg < (phase_lo[b] + binsize))
-        mean_amp[b] = np.mean(hi[phaserange])
-
-    p_j = np.zeros(len(phase_lo))
-    for b in range(len(phase_lo)):
-        p_j[b] = mean_amp[b] / sum(mean_amp)
-
-    h = -np.sum(p_j * np.log10(p_j))
-    h_max = np.log10(Nbins)
-    pac = (h_max - h) / h_max
+    pac = _mi_tort_batch(lo, hi, Nbins=Nbins)
 
     return pac
 
 
-def _ols(y, X):
-    """Custom OLS (to minimize outside dependecies)"""
+def _mi_tort_batch(lo, hi, Nbins=20):
+    """
+    Tort modulation index from prefiltered phase (lo) and amplitude (hi)
+    time series of any shape, reducing along the last (time) axis.
+    Equivalent to `mi_tort` with `filterfn=False`.
+    """
+    _batch_sanity(lo, hi)
 
-    dummy = np.repeat(1.0, X.shape[0])
-    X = np.hstack([X, dummy[:, np.newaxis]])
+    # Calculate the mean amplitude in each phase bin
+    amp_sums, counts = _phase_bin_sums(lo, hi, Nbins)
+    return _mi_tort_from_mean_amp(amp_sums / counts, Nbins)
 
-    beta_hat, resid, _, _ = np.linalg.lstsq(X, y)
-    y_hat = np.dot(X, beta_hat)
 
-    return y_hat, beta_hat
+def _phase_bin_sums(lo, hi, Nbins, edges=None):
+    """
+    Sum of the amplitudes (hi) and number of samples falling in each of
+    `Nbins` phase (lo) bins, uniformly distributed between -pi and pi, along
+    the last axis. Bins are moved to the last axis of the output.
+
+    By default, the bins are those of `mi_tort`, whose edges are in degrees.
+    Otherwise, `edges` are the `Nbins + 1` bin edges in radians. Either way,
+    a sample falls in a bin if its phase is >= the lower edge and < the
+    upper edge, exactly as in the original loops over the bins.
+
+    All time series are binned with a single weighted histogram
+    (`np.bincount`), each one getting its own range of `Nbins` bins. Samples
+    whose phase is outside of the bins are ignored.
+    """
+    lo, hi = np.broadcast_arrays(lo, hi)
+    shape = lo.shape[:-1] + (Nbins,)
+    lo = lo.reshape(-1, lo.shape[-1])
+    hi = hi.reshape(-1, hi.shape[-1])
+
+    if edges is None:
+        binsize = 360 / Nbins
+        lo = np.degrees(lo)
+        edges = np.arange(-180, 180, binsize)[:Nbins]
+        edges = np.append(edges, edges[-1] + binsize)
+
+    # Bin index of each sample, with one trash bin per series for the
+    # samples out of range (or NaN)
+    ixs = np.searchsorted(edges[:-1], lo, side='right') - 1
+    ixs[(ixs < 0) | ~(lo < edges[-1])] = Nbins
+    ixs += (Nbins + 1) * np.arange(len(lo))[:, np.newaxis]
+
+    n_out = len(lo) * (Nbins + 1)
+    amp_sums = np.bincount(ixs.ravel(), weights=hi.ravel(), minlength=n_out)
+    counts = np.bincount(ixs.ravel(), minlength=n_out).astype(float)
+    amp_sums, counts = [i_sum.reshape(-1, Nbins + 1)[:, :-1].reshape(shape)
+                        for i_sum in (amp_sums, counts)]
+    return amp_sums, counts
+
+
+def _mi_tort_from_mean_amp(mean_amp, Nbins):
+    """Tort modulation index from the mean amplitude in each phase bin"""
+    p_j = mean_amp / np.sum(mean_amp, axis=-1, keepdims=True)
+
+    h = -np.sum(p_j * np.log10(p_j), axis=-1)
+    h_max = np.log10(Nbins)
+    pac = (h_max - h) / h_max
+
+    return pac
 
 
 def glm(lo, hi, f_lo, f_hi, fs=1000, filterfn=None, filter_kwargs=None):
@@ -322,22 +372,44 @@ def glm(lo, hi, f_lo, f_hi, fs=1000, filterfn=None, filter_kwargs=None):
     # Make arrays the same size
     lo, hi = _trim_edges(lo, hi)
 
-    # First prepare GLM
-    y = hi
-    X_pre = np.vstack((np.cos(lo), np.sin(lo)))
-    X = X_pre.T
-    y_hat, beta_hat = _ols(y, X)
-    resid = y - y_hat
+    # Calculate PAC from GLM residuals
+    pac = _glm_batch(lo, hi)
+
+    return pac
+
+
+def _glm_batch(lo, hi):
+    """
+    GLM PAC from prefiltered phase (lo) and amplitude (hi) time series of any
+    shape, reducing along the last (time) axis. Equivalent to `glm` with
+    `filterfn=False`, with the OLS fit solved for all series at once.
+    """
+    _batch_sanity(lo, hi)
+    lo, hi = np.broadcast_arrays(lo, hi)
+    X = _glm_design(lo)
+    # Accumulate the normal equations in double precision, even for float32
+    # time series
+    XtX = np.einsum('...it,...jt->...ij', X, X, dtype=np.float64)
+    Xty = np.einsum('...it,...t->...i', X, hi, dtype=np.float64)
+    beta_hat = np.linalg.solve(XtX, Xty[..., np.newaxis])[..., 0]
+    resid = hi - np.einsum('...i,...it->...t', beta_hat.astype(X.dtype), X)
 
     # Calculate PAC from GLM residuals
-    pac = 1 - np.sum(resid ** 2) / np.sum(
-        (hi - np.mean(hi)) ** 2)
+    pac = 1 - np.sum(resid ** 2, axis=-1) / np.sum(
+        (hi - np.mean(hi, axis=-1, keepdims=True)) ** 2, axis=-1)
 
     return pac
 
 
+def _glm_design(lo):
+    """GLM design matrix (..., 3, n_times): cos, sin and an intercept"""
+    return np.concatenate([i_x[..., np.newaxis, :] for i_x in
+                           (np.cos(lo), np.sin(lo), np.ones_like(lo))],
+                          axis=-2)
+
+
 def mi_canolty(lo, hi, f_lo, f_hi, fs=1000, filterfn=None, filter_kwargs=None,
-               n_surr=100):
+               n_surr=100, random_state=0):
     """
     Calculate PAC using the modulation index (MI) method defined in Canolty,
     2006
@@ -368,6 +440,9 @@ def mi_canolty(lo, hi, f_lo, f_hi, fs=1000, filterfn=None, filter_kwargs=None,
         Keyword parameters to pass to `filterfn(.)`
     n_surr : int
         Number of surrogate tests to run to calculate normalized MI
+    random_state : None | int | np.random.RandomState | np.random.Generator
+        The random number generator drawing the phase shifts of the
+        surrogates, or the seed to create one (default = 0)
 
     Returns
     -------
@@ -383,8 +458,9 @@ def mi_canolty(lo, hi, f_lo, f_hi, fs=1000, filterfn=None, filter_kwargs=None,
     >>> lo = np.sin(t * 2 * np.pi * 6) # Create low frequency carrier
     >>> hi = np.sin(t * 2 * np.pi * 100) # Create modulated oscillation
     >>> hi[np.angle(hilbert(lo)) > -np.pi*.5] = 0 # Clip to 1/4 of cycle
+    >>> lo += np.random.RandomState(0).randn(len(t)) # Add noise to the phase
     >>> mi_canolty(lo, hi, (4,8), (80,150)) # Calculate PAC
-    1.1605177063713188
+    0.8110439649568911
     """
 
     # Arg check
@@ -409,18 +485,28 @@ def mi_canolty(lo, hi, f_lo, f_hi, fs=1000, filterfn=None, filter_kwargs=None,
     # Make arrays the same size
     lo, hi = _trim_edges(lo, hi)
 
+    # Calculate z-scored modulation index
+    return _mi_canolty_batch(lo, hi, n_surr=n_surr, random_state=random_state)
+
+
+def _mi_canolty_batch(lo, hi, n_surr=100, random_state=0):
+    """
+    Canolty modulation index from prefiltered phase (lo) and amplitude (hi)
+    time series of any shape, reducing along the last (time) axis.
+    Equivalent to `mi_canolty` with `filterfn=False`. The same phase shifts
+    are used for the surrogates of every time series.
+    """
+    _batch_sanity(lo, hi)
+
     # Calculate modulation index
-    pac = np.abs(np.mean(hi * np.exp(1j * lo)))
+    pac = np.abs(np.mean(hi * np.exp(1j * lo), axis=-1))
 
     # Calculate surrogate MIs
-    pacS = np.zeros(n_surr)
-    np.random.seed(0)
-    for s in range(n_surr):
-        loS = np.roll(lo, np.random.randint(len(lo)))
-        pacS[s] = np.abs(np.mean(hi * np.exp(1j * loS)))
+    pacS = _pac_surrogates(lo, hi, 'mi_canolty', n_surr=n_surr,
+                           random_state=random_state)
 
     # Return z-score of observed PAC compared to null distribution
-    return (pac - np.mean(pacS)) / np.std(pacS)
+    return (pac - np.mean(pacS, axis=-1)) / np.std(pacS, axis=-1)
 
 
 def ozkurt(lo, hi, f_lo, f_hi, fs=1000, filterfn=None, filter_kwargs=None):
@@ -493,11 +579,220 @@ def ozkurt(lo, hi, f_lo, f_hi, fs=1000, filterfn=None, filter_kwargs=None):
     lo, hi = _trim_edges(lo, hi)
 
     # Calculate PAC
-    pac = np.abs(np.sum(hi * np.exp(1j * lo))) / \
-        (np.sqrt(len(lo)) * np.sqrt(np.sum(hi**2)))
+    pac = _ozkurt_batch(lo, hi)
+    return pac
+
+
+def _ozkurt_batch(lo, hi):
+    """
+    Ozkurt PAC from prefiltered phase (lo) and amplitude (hi) time series of
+    any shape, reducing along the last (time) axis. Equivalent to `ozkurt`
+    with `filterfn=False`.
+    """
+    _batch_sanity(lo, hi)
+    n_times = lo.shape[-1]
+    pac = np.abs(np.sum(hi * np.exp(1j * lo), axis=-1)) / \
+        (np.sqrt(n_times) * np.sqrt(np.sum(hi**2, axis=-1)))
     return pac
 
 
+def _pac_stats(lo, hi, pac_func, Nbins=20):
+    """
+    Sufficient statistics of a PAC metric, from prefiltered phase (lo) and
+    amplitude (hi) arrays of any shape, summed along the last (time) axis.
+
+    The statistics of consecutive chunks of data add up to those of the
+    whole time series, and `_pac_from_stats` turns them into the PAC value.
+    They are only available for 'ozkurt', 'plv', 'glm' and 'mi_tort'.
+    Returns a list of arrays, the last being the number of samples.
+    """
+    _batch_sanity(lo, hi)
+    lo, hi = np.broadcast_arrays(lo, hi)
+    if pac_func == 'ozkurt':
+        stats = [np.sum(hi * np.exp(1j * lo), axis=-1),
+                 np.sum(hi ** 2, axis=-1)]
+    elif pac_func == 'plv':
+        stats = [np.sum(np.exp(1j * (lo - hi)), axis=-1)]
+    elif pac_func == 'glm':
+        X = _glm_design(lo)
+        stats = [np.einsum('...it,...jt->...ij', X, X, dtype=np.float64),
+                 np.einsum('...it,...t->...i', X, hi, dtype=np.float64),
+                 np.sum(hi ** 2, axis=-1)]
+    elif pac_func == 'mi_tort':
+        stats = list(_phase_bin_sums(lo, hi, Nbins))
+    else:
+        raise ValueError('Sufficient statistics are not available for '
+                         'PAC function %s' % pac_func)
+    return stats + [np.full(lo.shape[:-1], lo.shape[-1], dtype=float)]
+
+
+def _pac_from_stats(stats, pac_func, Nbins=20):
+    """Calculate PAC from the sufficient statistics of `_pac_stats`"""
+    n_times = stats[-1]
+    if pac_func == 'ozkurt':
+        sum_z, sum_amp2 = stats[:2]
+        pac = np.abs(sum_z) / (np.sqrt(n_times) * np.sqrt(sum_amp2))
+    elif pac_func == 'plv':
+        pac = np.abs(stats[0]) / n_times
+    elif pac_func == 'glm':
+        XtX, Xty, yty = stats[:3]
+        beta_hat = np.linalg.solve(XtX, Xty[..., np.newaxis])[..., 0]
+        ss_resid = yty - np.sum(beta_hat * Xty, axis=-1)
+        ss_total = yty - Xty[..., 2] ** 2 / n_times
+        pac = 1 - ss_resid / ss_total
+    elif pac_func == 'mi_tort':
+        amp_sums, counts = stats[:2]
+        pac = _mi_tort_from_mean_amp(amp_sums / counts, Nbins)
+    else:
+        raise ValueError('Sufficient statistics are not available for '
+                         'PAC function %s' % pac_func)
+    return pac
+
+
+def _pac_sliding(lo, hi, pac_func, n_window, n_step, Nbins=20,
+                 n_chunk=2 ** 14):
+    """
+    PAC in windows of `n_window` samples every `n_step` samples, along the
+    last axis of prefiltered phase (lo) and amplitude (hi) arrays of any
+    shape. Returns an array of shape (..., n_windows).
+
+    The time series are cut in segments of gcd(n_window, n_step) samples.
+    The sufficient statistics of the segments (see `_pac_stats`) are summed
+    cumulatively, and those of each window are the difference of two
+    cumulative sums, so the cost is linear in the number of samples however
+    much the windows overlap.
+
+    The statistics of a segment take 4 ('ozkurt'), 14 ('glm') or
+    2 * Nbins + 1 ('mi_tort') floats per time series. When the window and the
+    step are coprime, segments are single samples, and the cumulative sums
+    would take that many times the memory of `lo`. The windows are thus
+    computed in chunks spanning about max(2 * n_window, n_chunk) samples,
+    which bounds the memory of the statistics whatever the length of the
+    data, and repeats the sums of at most one window per chunk.
+    """
+    _batch_sanity(lo, hi)
+    lo, hi = np.broadcast_arrays(lo, hi)
+    n_times = lo.shape[-1]
+    if n_window < 1 or n_step < 1 or n_window > n_times:
+        raise ValueError('Windows must be between 1 and %d samples long and '
+                         'the step must be positive, got %s and %s'
+                         % (n_times, n_window, n_step))
+    n_windows = (n_times - n_window) // n_step + 1
+    n_windows_chunk = (max(2 * n_window, n_chunk) - n_window) // n_step + 1
+    pac = []
+    for start in range(0, n_windows, n_windows_chunk):
+        stop = min(start + n_windows_chunk, n_windows)
+        i_times = slice(start * n_step, (stop - 1) * n_step + n_window)
+        pac.append(_pac_sliding_chunk(lo[..., i_times], hi[..., i_times],
+                                      pac_func, n_window, n_step, Nbins))
+    return np.concatenate(pac, axis=-1)
+
+
+def _pac_sliding_chunk(lo, hi, pac_func, n_window, n_step, Nbins=20):
+    """
+    PAC of all the sliding windows of `lo` and `hi`, whose length fits the
+    windows exactly, from cumulative sums of statistics (see `_pac_sliding`)
+    """
+    n_windows = (lo.shape[-1] - n_window) // n_step + 1
+    n_seg = int(np.gcd(n_window, n_step))
+    n_segs = ((n_windows - 1) * n_step + n_window) // n_seg
+    shape = lo.shape[:-1] + (n_segs, n_seg)
+    lo = lo[..., :n_segs * n_seg].reshape(shape)
+    hi = hi[..., :n_segs * n_seg].reshape(shape)
+
+    # Statistics have the segments on this axis, followed by their own axes
+    axis = lo.ndim - 2
+    starts = np.arange(n_windows) * (n_step // n_seg)
+    stops = starts + n_window // n_seg
+    stats = []
+    for i_stat in _pac_stats(lo, hi, pac_func, Nbins=Nbins):
+        i_stat = np.cumsum(i_stat, axis=axis)
+        i_stat = np.concatenate([np.zeros_like(i_stat.take([0], axis=axis)),
+                                 i_stat], axis=axis)
+        stats.append(i_stat.take(stops, axis=axis) -
+                     i_stat.take(starts, axis=axis))
+    return _pac_from_stats(stats, pac_func, Nbins=Nbins)
+
+
+def _check_random_state(random_state):
+    """Turn `random_state` into a RandomState or Generator instance"""
+    if random_state is None:
+        return np.random.mtrand._rand
+    if isinstance(random_state, (int, np.integer)):
+        return np.random.RandomState(random_state)
+    if hasattr(random_state, 'integers') or \
+            isinstance(random_state, np.random.RandomState):
+        return random_state
+    raise ValueError('random_state must be None, an int, a RandomState or '
+                     'a Generator instance, got %s' % (random_state,))
+
+
+def _surrogate_shifts(n_times, n_surr, random_state=0):
+    """Draw `n_surr` random circular shifts of a time series"""
+    rng = _check_random_state(random_state)
+    if hasattr(rng, 'integers'):  # np.random.Generator
+        return rng.integers(n_times, size=n_surr)
+    return rng.randint(n_times, size=n_surr)
+
+
+def _shifted_sums(lo, hi, shifts):
+    """
+    Sum over the last (time) axis of ``hi * np.exp(1j * lo)``, with `lo`
+    circularly shifted (as in `np.roll`) by each of `shifts`. Returns an
+    array of shape (..., len(shifts)).
+
+    The sums for all the possible shifts are the circular cross-correlation
+    of `hi` and ``np.exp(1j * lo)``, computed with one FFT per time series.
+    """
+    lo, hi = np.broadcast_arrays(lo, hi)
+    n_times = lo.shape[-1]
+    xcorr = np.fft.ifft(np.fft.fft(hi, axis=-1) *
+                        np.fft.ifft(np.exp(1j * lo), axis=-1), axis=-1)
+    return xcorr[..., shifts] * n_times
+
+
+def _pac_surrogates(lo, hi, pac_func, n_surr=100, random_state=0, Nbins=20):
+    """
+    PAC of surrogate data, where the phase (lo) time series is circularly
+    shifted by random amounts, from prefiltered phase and amplitude (hi)
+    arrays of any shape. The same shifts are used for every time series.
+    Returns an array of shape (..., n_surr).
+    """
+    _batch_sanity(lo, hi)
+    shifts = _surrogate_shifts(lo.shape[-1], n_surr, random_state)
+    return _pac_shifted(lo, hi, pac_func, shifts, Nbins=Nbins)
+
+
+def _pac_shifted(lo, hi, pac_func, shifts, Nbins=20):
+    """
+    PAC with the phase (lo) time series circularly shifted (as in `np.roll`)
+    by each of `shifts`, from prefiltered phase and amplitude (hi) arrays of
+    any shape. Returns an array of shape (..., len(shifts)).
+
+    The PAC of 'mi_canolty', 'ozkurt' and 'plv' is computed for all shifts
+    at once with `_shifted_sums`, the others one shift at a time.
+    """
+    n_times = lo.shape[-1]
+    if pac_func == 'mi_canolty':
+        pacS = np.abs(_shifted_sums(lo, hi, shifts)) / n_times
+    elif pac_func == 'ozkurt':
+        norm = np.sqrt(n_times) * np.sqrt(np.sum(hi ** 2, axis=-1))
+        pacS = np.abs(_shifted_sums(lo, hi, shifts)) / norm[..., np.newaxis]
+    elif pac_func == 'plv':
+        pacS = np.abs(_shifted_sums(lo, np.exp(-1j * hi), shifts)) / n_times
+    elif pac_func in ('glm', 'mi_tort'):
+        kwargs = dict(Nbins=Nbins) if pac_func == 'mi_tort' else dict()
+        func = _glm_batch if pac_func == 'glm' else _mi_tort_batch
+        pacS = [func(np.roll(lo, shift, axis=-1), hi, **kwargs)
+                for shift in shifts]
+        pacS = np.concatenate([i_pac[..., np.newaxis] for i_pac in pacS],
+                              axis=-1)
+    else:
+        raise ValueError('Surrogates are not available for PAC function %s'
+                         % pac_func)
+    return pacS
+
+
 def otc(x, f_hi, f_step, fs=1000,
         w=3, event_prc=95, t_modsig=None, t_buffer=.01):
     """
@@ -566,12 +861,13 @@ def otc(x, f_hi, f_step, fs=1000,
     f0s = np.arange(f_hi[0], f_hi[1], f_step)
     tf = _morletT(x, f0s, w=w, fs=fs)
 
-    # Find the high frequency activity event times
+    # Find the high frequency activity event times of all frequencies
     F = len(f0s)
     a_events = np.zeros(F, dtype=object)
-    for f in range(F):
-        a_events[f] = _peaktimes(
-            zscore(np.abs(tf[f])), prc=event_prc, t_buffer=t_buffer)
+    for f, f_events in enumerate(_peaktimes(
+            np.asarray(zscore(np.abs(tf), axis=-1)), prc=event_prc,
+            t_buffer=t_buffer)):
+        a_events[f] = f_events
 
     # Calculate the modulation signal
     samp_modsig = np.arange(t_modsig[0] * fs, t_modsig[1] * fs)
@@ -590,10 +886,8 @@ def otc(x, f_hi, f_step, fs=1000,
         a_events[f] = a_events[f][mask]
 
         # Calculate the average LFP around each high frequency event
-        E = len(a_events[f])
-        for e in range(E):
-            cur_ecog = x[a_events[f][e] + samp_modsig]
-            mod_sig[f] = mod_sig[f] + cur_ecog / E
+        if len(a_events[f]) > 0:
+            mod_sig[f] = x[a_events[f][:, np.newaxis] + samp_modsig].mean(0)
 
     # Calculate modulation strength, the range of the modulation signal
     mod_strength = np.zeros(F)
@@ -612,29 +906,53 @@ def _peaktimes(x, prc=95, t_buffer=.01, fs=1000):
 
     Parameters
     ----------
-    x : array
-        Time series of power
+    x : array, 1d or 2d
+        Time series of power. If 2d, events are detected in each row (e.g.,
+        each frequency), with its own threshold
     prc : float (in range 0-100)
         The percentile threshold of x for an event to be declares
     t_buffer : float
         Minimum time (seconds) in between events
     fs : float
         Sampling rate
+
+    Returns
+    -------
+    events : array of int, or list of arrays of int if x is 2d
+        The sample of the peak of each event
     """
     if np.logical_or(prc < 0, prc >= 100):
         raise ValueError('Percentile threshold must be between 0 and 100.')
 
-    samp_buffer = np.int(np.round(t_buffer * fs))
-    hi = x > np.percentile(x, prc)
+    samp_buffer = int(np.round(t_buffer * fs))
+    x = np.asarray(x)
+    x_2d = np.atleast_2d(x)
+    n_rows, T = x_2d.shape
+    # Pad each row so that events don't merge across rows, then detect the
+    # events of all rows in one pass
+    n_pad = samp_buffer + 2
+    x_flat = np.zeros((n_rows, T + n_pad), dtype=x_2d.dtype)
+    x_flat[:, :T] = x_2d
+    hi = np.zeros(x_flat.shape, dtype=bool)
+    hi[:, :T] = x_2d > np.percentile(x_2d, prc, axis=-1)[:, np.newaxis]
+    x_flat, hi = x_flat.ravel(), hi.ravel()
     event_intervals = _chunk_time(hi, samp_buffer=samp_buffer)
-    E = np.int(np.size(event_intervals) / 2)
-    events = np.zeros(E, dtype=object)
 
-    for e in range(E):
-        temp = x[np.arange(event_intervals[e][0], event_intervals[e][1] + 1)]
-        events[e] = event_intervals[e][0] + np.argmax(temp)
+    # Index of the first maximum of each interval
+    lengths = event_intervals[:, 1] - event_intervals[:, 0] + 1
+    starts = np.cumsum(lengths) - lengths
+    samples = np.arange(lengths.sum()) + np.repeat(
+        event_intervals[:, 0] - starts, lengths)
+    values = x_flat[samples]
+    maxima = np.maximum.reduceat(values, starts) if len(starts) else values
+    is_max = np.flatnonzero(values == np.repeat(maxima, lengths))
+    events = samples[is_max[np.searchsorted(is_max, starts)]]
 
-    return events
+    if x.ndim == 1:
+        return events
+    rows = events // (T + n_pad)
+    return np.split(events - rows * (T + n_pad),
+                    np.searchsorted(rows, np.arange(1, n_rows)))
 
 
 def _chunk_time(x, samp_buffer=0):
@@ -644,13 +962,13 @@ def _chunk_time(x, samp_buffer=0):
     Parameters
     ----------
     x : array
-        Array of integers
+        Sorted array of integers, or boolean mask of the samples to chunk
     samp_buffer : int
         Minimum number of samples between chunks
 
     Returns
     -------
-    chunks : array (#chunks x 2)
+    chunks : array of int (#chunks x 2)
         List of the sample bounds for each chunk
     """
     if samp_buffer < 0:
@@ -659,34 +977,16 @@ def _chunk_time(x, samp_buffer=0):
     if samp_buffer != int(samp_buffer):
         raise ValueError('Number of samples must be an integer')
 
-    if type(x[0]) == np.bool_:
-        Xs = np.arange(len(x))
-        x = Xs[x]
-    X = len(x)
-
-    cur_start = x[0]
-    cur_samp = x[0]
-    Nchunk = 0
-    chunks = []
-    for i in range(1, X):
-        if x[i] > (cur_samp + samp_buffer + 1):
-            if Nchunk == 0:
-                chunks = [cur_start, cur_samp]
-            else:
-                chunks = np.vstack([chunks, [cur_start, cur_samp]])
-
-            Nchunk = Nchunk + 1
-            cur_start = x[i]
-
-        cur_samp = x[i]
-
-    # Add final row to chunk
-    if Nchunk == 0:
-        chunks = [[cur_start, cur_samp]]
-    else:
-        chunks = np.vstack([chunks, [cur_start, cur_samp]])
+    x = np.asarray(x)
+    if x.dtype == np.bool_:
+        x = np.flatnonzero(x)
+    if len(x) == 0:
+        return np.zeros((0, 2), dtype=int)
 
-    return chunks
+    # A new chunk starts after each gap longer than the buffer
+    breaks = np.flatnonzero(np.diff(x) > samp_buffer + 1)
+    return np.array([x[np.r_[0, breaks + 1]], x[np.r_[breaks, len(x) - 1]]],
+                    dtype=int).T
 
 
 def _morletT(x, f0s, w=3, fs=1000, s=1):
@@ -714,17 +1014,7 @@ def _morletT(x, f0s, w=3, fs=1000, s=1):
     mwt : 2-D array
         time-frequency representation of signal x
     """
-    if w <= 0:
-        raise ValueError(
-            'Number of cycles in a filter must be a positive number.')
-
-    T = len(x)
-    F = len(f0s)
-    mwt = np.zeros([F, T], dtype=complex)
-    for f in range(F):
-        mwt[f] = morletf(x, f0s[f], fs=fs, w=w, s=s)
-
-    return mwt
+    return morlet_transform(x, f0s, fs=fs, w=w, s=s)
 
 
 def comodulogram(lo, hi, p_range, a_range, dp, da, fs=1000,
@@ -779,7 +1069,7 @@ def comodulogram(lo, hi, p_range, a_range, dp, da, fs=1000,
     >>> comod = comodulogram(lo, hi, (5,25), (75,175), 10, 50) # Calculate PAC
     >>> print comod
     [[ 0.32708628  0.32188585]
-     [ 0.3295994   0.32439953]]
+     [ 0.3295824   0.32440344]]
     """
 
     # Arg check
@@ -791,32 +1081,118 @@ def comodulogram(lo, hi, p_range, a_range, dp, da, fs=1000,
         raise ValueError('Width of hi frequqnecy range must be positive')
 
     # method check
-    method2fun = {'plv': plv, 'mi_tort': mi_tort, 'mi_canolty': mi_canolty,
-                  'ozkurt': ozkurt, 'glm': glm}
-    pac_fun = method2fun.get(pac_method, None)
-    if pac_fun == None:
+    if pac_method not in ('plv', 'mi_tort', 'mi_canolty', 'ozkurt', 'glm'):
         raise ValueError('PAC method given is invalid.')
 
     # Calculate palette frequency parameters
     f_phases = np.arange(p_range[0], p_range[1], dp)
     f_amps = np.arange(a_range[0], a_range[1], da)
-    P = len(f_phases)
-    A = len(f_amps)
+    f_los = [(f_ph, f_ph + dp) for f_ph in f_phases]
+    f_his = [(f_am, f_am + da) for f_am in f_amps]
 
     # Calculate PAC for every combination of P and A
-    comod = np.zeros((P, A))
-    for p in range(P):
-        f_lo = (f_phases[p], f_phases[p] + dp)
+    return _comodulogram(lo, hi, f_los, f_his, fs=fs, pac_method=pac_method,
+                         filterfn=filterfn, filter_kwargs=filter_kwargs)
 
-        for a in range(A):
-            f_hi = (f_amps[a], f_amps[a] + da)
 
-            comod[p, a] = pac_fun(lo, hi, f_lo, f_hi, fs=fs,
-                                  filterfn=filterfn, filter_kwargs=filter_kwargs)
+def _comodulogram(lo, hi, f_los, f_his, fs=1000, pac_method='mi_tort',
+                  filterfn=None, filter_kwargs=None):
+    """
+    Comodulogram engine: PAC between each of the phase bands `f_los` and
+    each of the amplitude bands `f_his`, returned as an array of shape
+    (len(f_los), len(f_his)).
+
+    Each band is filtered and Hilbert transformed once, instead of once per
+    cell, and the PAC values of one phase band are computed for all the
+    amplitude bands in one batched reduction (a single matrix product for
+    'ozkurt'). Every cell is computed on the same samples as the
+    corresponding PAC function, i.e., after `_trim_edges`.
+    """
+    batch_funcs = {'mi_tort': _mi_tort_batch, 'mi_canolty': _mi_canolty_batch,
+                   'glm': _glm_batch, 'plv': _plv_batch,
+                   'ozkurt': _ozkurt_batch}
+    func = batch_funcs[pac_method]
+    if filterfn is None:
+        filterfn = firf
+    if filter_kwargs is None:
+        filter_kwargs = {}
+    if filterfn is False:
+        # Expert mode, the bands are not used
+        pac = func(*_trim_edges(lo, hi))
+        return np.full((len(f_los), len(f_his)), pac)
+    for f_lo, f_hi in zip(f_los, f_his):
+        _range_sanity(f_lo, f_hi)
 
+    # Filter each band once. Filtered signals are placed back on the time
+    # axis of the raw data (zero outside of their valid samples), so that the
+    # samples of a cell are the intersection of its two valid ranges
+    n_times = len(lo)
+    ph, start_ph = _filter_bands(lo, f_los, fs, filterfn, filter_kwargs,
+                                 np.angle)
+    amp, start_am = _filter_bands(hi, f_his, fs, filterfn, filter_kwargs,
+                                  np.abs)
+
+    if pac_method == 'ozkurt':
+        valid_ph = _valid_mask(start_ph, n_times)
+        valid_am = _valid_mask(start_am, n_times)
+        sum_z = np.dot(np.exp(1j * ph) * valid_ph, amp.T)
+        sum_amp2 = np.dot(valid_ph, (amp ** 2).T)
+        counts = np.dot(valid_ph, valid_am.T)
+        return np.abs(sum_z) / (np.sqrt(counts) * np.sqrt(sum_amp2))
+
+    comod = np.zeros((len(f_los), len(f_his)))
+    for p, f_lo in enumerate(f_los):
+        if pac_method == 'plv':
+            # The phase of the amplitude is filtered in the phase band too,
+            # so it can't be shared across phase bands
+            for a in range(len(f_his)):
+                i_amp = amp[a, start_am[a]:n_times - start_am[a]]
+                hi_ph = np.angle(hilbert(filterfn(i_amp, f_lo, fs,
+                                                  **filter_kwargs)))
+                start_hi = (n_times - len(hi_ph)) // 2
+                i_start = max(start_hi, start_ph[p])
+                i_trim = i_start - start_hi
+                comod[p, a] = func(ph[p, i_start:n_times - i_start],
+                                   hi_ph[i_trim:len(hi_ph) - i_trim])
+            continue
+
+        # Amplitude bands with a shorter filter share the samples of this
+        # phase band and are reduced in one call, the others one at a time
+        starts = np.maximum(start_am, start_ph[p])
+        for i_start in np.unique(starts):
+            ixs_am = np.where(starts == i_start)[0]
+            comod[p, ixs_am] = func(ph[p, i_start:n_times - i_start],
+                                    amp[ixs_am, i_start:n_times - i_start])
     return comod
 
 
+def _filter_bands(x, f_ranges, fs, filterfn, filter_kwargs, transform):
+    """
+    Filter `x` in each band of `f_ranges` and apply `transform` (e.g.,
+    `np.angle`) to the analytic signals. Returns an array of shape
+    (n_bands, len(x)), zero outside of the valid samples of each band, and
+    the index of the first valid sample of each band.
+    """
+    n_times = len(x)
+    out = np.zeros((len(f_ranges), n_times))
+    starts = np.zeros(len(f_ranges), dtype=int)
+    for ii, f_range in enumerate(f_ranges):
+        x_filt = transform(hilbert(filterfn(x, f_range, fs, **filter_kwargs)))
+        if (n_times - len(x_filt)) % 2 != 0:
+            raise ValueError(
+                'Difference in filtered signal lengths should be even')
+        starts[ii] = (n_times - len(x_filt)) // 2
+        out[ii, starts[ii]:starts[ii] + len(x_filt)] = x_filt
+    return out, starts
+
+
+def _valid_mask(starts, n_times):
+    """Mask of the valid samples of signals starting at `starts`"""
+    ixs = np.arange(n_times)
+    return ((ixs >= starts[:, np.newaxis]) &
+            (ixs < n_times - starts[:, np.newaxis])).astype(float)
+
+
 def pa_series(lo, hi, f_lo, f_hi, fs=1000, filterfn=None, filter_kwargs=None):
     """
     Calculate the phase and amplitude time series
@@ -888,9 +1264,9 @@ def pa_dist(pha, amp, Nbins=10):
 
     Parameters
     ----------
-    pha : array
+    pha : array, shape (..., n_times)
         Phase time series
-    amp : array
+    amp : array, shape (..., n_times)
         Amplitude time series
     Nbins : int
         Number of phase bins in the distribution,
@@ -898,7 +1274,7 @@ def pa_dist(pha, amp, Nbins=10):
 
     Returns
     -------
-    dist : array
+    dist : array, shape (..., Nbins)
         Average amplitude in each phase bins
     phase_bins : array
         The boundaries to each phase bin. Note the length is 1 + len(dist)
@@ -915,23 +1291,19 @@ def pa_dist(pha, amp, Nbins=10):
     >>> pha, amp = pa_series(lo, hi, (4,8), (80,150))
     >>> phase_bins, dist = pa_dist(pha, amp)
     >>> print dist
-    [  7.21154110e-01   8.04347122e-01   4.49207087e-01   2.08747058e-02
-       8.03854240e-05   3.45166617e-05   3.45607343e-05   3.51091029e-05
-       7.73644631e-04   1.63514941e-01]
+    [  7.21154110e-01   8.04347122e-01   4.49207087e-01   2.08986926e-02
+       8.08901617e-05   3.45166617e-05   3.45607343e-05   3.51301712e-05
+       7.72755768e-04   1.63177226e-01]
     """
     if np.logical_or(Nbins < 2, Nbins != int(Nbins)):
         raise ValueError(
             'Number of bins in the low frequency oscillation cycle must be an integer >1.')
-    if len(pha) != len(amp):
+    if np.shape(pha) != np.shape(amp):
         raise ValueError(
             'Phase and amplitude time series must be of same length.')
 
     phase_bins = np.linspace(-np.pi, np.pi, int(Nbins + 1))
-    dist = np.zeros(int(Nbins))
-
-    for b in range(int(Nbins)):
-        t_phase = np.logical_and(pha >= phase_bins[b],
-                                 pha < phase_bins[b + 1])
-        dist[b] = np.mean(amp[t_phase])
+    amp_sums, counts = _phase_bin_sums(pha, amp, int(Nbins), phase_bins)
+    dist = amp_sums / counts
 
     return phase_bins[:-1], dist
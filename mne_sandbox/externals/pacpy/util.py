@@ -2,20 +2,42 @@ from __future__ import division
 import numpy as np
 import math
 
+try:
+    # Keeps single precision
+    from scipy.fft import fft, ifft, irfft, rfft, next_fast_len
+except ImportError:  # scipy < 1.4
+    from numpy.fft import fft, ifft, irfft, rfft
+    try:
+        from scipy.fftpack import next_fast_len
+    except ImportError:  # scipy < 0.18
+        def next_fast_len(target):
+            return 2 ** int(math.ceil(math.log(target, 2)))
+
 
 def fasthilbert(x, axis=-1):
     """
-    Redefinition of scipy.signal.hilbert, which is very slow for some lengths
-    of the signal x. This version zero-pads the signal to the next power of 2
-    for speed.
+    Redefinition of scipy.signal.hilbert, with the same output. The forward
+    transform is a real FFT, and single precision signals are kept in
+    single precision.
+
+    x : array
+        Real signal, of any number of dimensions
+    axis : int
+        The axis along which to compute the analytic signal
+
+    Returns
+    -------
+    x_a : array
+        The analytic signal, of the same shape as x
     """
-    x = np.array(x)
-    N = x.shape[axis]
-    N2 = 2**(int(math.log(len(x), 2)) + 1)
-    Xf = np.fft.fft(x, N2, axis=axis)
-    h = np.zeros(N2)
-    h[0] = 1
-    h[1:(N2 + 1) // 2] = 2
+    x = np.moveaxis(np.asarray(x), axis, -1)
+    N = x.shape[-1]
+    Xf = rfft(x, axis=-1)
+
+    # One-sided spectrum: double the positive frequencies, except Nyquist
+    h = np.ones(Xf.shape[-1], dtype=Xf.real.dtype)
+    h[1:(N + 1) // 2] = 2
+    Xa = np.zeros(Xf.shape[:-1] + (N,), dtype=Xf.dtype)
+    Xa[..., :Xf.shape[-1]] = Xf * h
 
-    x = np.fft.ifft(Xf * h, axis=axis)
-    return x[:N]
+    return np.moveaxis(ifft(Xa, axis=-1), -1, axis)